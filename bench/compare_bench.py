@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Compare benchmark results recorded by run_bench.py under two labels.
+
+Runs are matched by scenario, number of hosts, commands and poh arguments,
+repeated runs are summarized by their median. Every measure of the second
+label is shown next to the first one's along with their ratio.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+
+_MEASURES = ['wall_time', 'time_to_first_output', 'peak_rss_kb', 'max_fds',
+             'max_children']
+
+def _median(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def _run_key(record):
+    return (record['scenario'], record['hosts'], tuple(record['commands']),
+            tuple(record['poh_args']))
+
+def _medians_by_run(records, label):
+    runs = collections.OrderedDict()
+    for record in records:
+        if record['label'] == label:
+            runs.setdefault(_run_key(record), []).append(record)
+    return collections.OrderedDict(
+        (key, {measure: _median(record[measure] for record in run_records)
+               for measure in _MEASURES})
+        for key, run_records in runs.items()
+    )
+
+def _formatted_measure(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.4f}'.format(value)
+    return str(value)
+
+def _formatted_ratio(old, new):
+    if old is None or new is None or not old:
+        return '-'
+    return '{:.2f}x'.format(new / old)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('results', help="File with the recorded results")
+    parser.add_argument('old_label', help="Label to compare against")
+    parser.add_argument('new_label', help="Label to compare")
+    args = parser.parse_args()
+
+    with open(args.results) as results_file:
+        records = [json.loads(line) for line in results_file if line.strip()]
+    old_runs = _medians_by_run(records, args.old_label)
+    new_runs = _medians_by_run(records, args.new_label)
+
+    for key, new_measures in new_runs.items():
+        old_measures = old_runs.get(key)
+        if old_measures is None:
+            continue
+        scenario, hosts, commands, poh_args = key
+        print("{} with {} hosts $ poh {}".format(
+            scenario, hosts, ' '.join(poh_args + ('--',) + commands)
+        ))
+        for measure in _MEASURES:
+            print("  {:22s} {:>12} {:>12} {:>8}".format(
+                measure, _formatted_measure(old_measures[measure]),
+                _formatted_measure(new_measures[measure]),
+                _formatted_ratio(old_measures[measure],
+                                 new_measures[measure])
+            ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Check how long starting poh takes against a budget.
+
+Every scenario is run a number of times under python's -X importtime, and
+its cost is the median of the time spent importing modules that a bare
+interpreter doesn't import. The check fails if a scenario goes over its
+budget, or if importing poh as a library pulls in modules that poh only
+imports where they're used.
+
+-X importtime needs python 3.7 or later.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import os
+import subprocess
+import sys
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_REPO_DIR = os.path.dirname(_BENCH_DIR)
+
+# Arguments for python of every scenario
+_SCENARIOS = collections.OrderedDict([
+    ('library', ['-c', 'import poh']),
+    ('version', ['-m', 'poh', '-V']),
+    ('dry-run', ['-m', 'poh', '-D', '-S', 'server', '--', 'true']),
+])
+
+# Milliseconds of imports every scenario may take
+_BUDGETS_MS = {
+    'library': 25.0,
+    'version': 45.0,
+    'dry-run': 70.0,
+}
+
+# Modules importing poh as a library must not import
+_LAZY_MODULES = [
+    'argparse', 'datetime', 'json', 'logging', 'random', 'shlex', 'shutil',
+    'subprocess', 'tempfile', 'textwrap', 'uuid',
+]
+
+def _create_argparser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__
+    )
+    add_arg = parser.add_argument
+    add_arg('-r', '--repeat', type=int, default=5,
+            help="Number of runs of every scenario. (default: %(default)s)")
+    add_arg('-s', '--scenario', action='append', dest='scenarios',
+            choices=list(_SCENARIOS.keys()), default=[],
+            help="Scenario to check, all of them by default. (+)")
+    return parser
+
+def _imports(python_args):
+    """Run python with python_args, return the self time of every import."""
+    env = dict(os.environ)
+    python_path = [_REPO_DIR]
+    if env.get('PYTHONPATH'):
+        python_path.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(python_path)
+    # poh reads servers from stdin when it isn't a terminal
+    with open(os.devnull, 'r+') as devnull:
+        proc = subprocess.Popen(
+            [sys.executable, '-X', 'importtime'] + python_args, env=env,
+            stdin=devnull, stdout=devnull, stderr=subprocess.PIPE
+        )
+        _, stderr = proc.communicate()
+    self_times = {}
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            # The header line
+            continue
+        self_times[name.strip()] = int(self_us) / 1000.0
+    return self_times
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def main():
+    args = _create_argparser().parse_args()
+    if sys.version_info < (3, 7):
+        sys.exit("-X importtime needs python 3.7 or later")
+    scenarios = args.scenarios or list(_SCENARIOS.keys())
+    bare_modules = set(_imports(['-c', 'pass']))
+
+    failed = False
+    for scenario in scenarios:
+        costs = []
+        for _ in range(args.repeat):
+            self_times = _imports(_SCENARIOS[scenario])
+            costs.append(sum(self_time
+                             for module, self_time in self_times.items()
+                             if module not in bare_modules))
+        cost = _median(costs)
+        budget = _BUDGETS_MS[scenario]
+        status = 'ok'
+        if cost > budget:
+            status = 'OVER BUDGET'
+            failed = True
+        print("{:10s} {:7.2f}ms (budget {:6.2f}ms) {}".format(
+            scenario, cost, budget, status
+        ))
+        if scenario == 'library':
+            eager = sorted(module for module in _LAZY_MODULES
+                           if module in self_times)
+            if eager:
+                print("{:10s} imports {}".format('', ', '.join(eager)))
+                failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""Benchmark poh runs against a local fake ssh.
+
+Every run puts fake_ssh first on PATH as 'ssh', feeds poh the names of
+the hosts on stdin and watches the poh process until it exits. A JSON line
+is appended to the output file for every run, with the wall time, the time
+to the first byte of output, the peak RSS, and the highest number of open
+file descriptors and of child processes seen, along with what was run and
+by which version of poh, so that results of different versions can be
+compared with compare_bench.py. poh is run without its history of earlier
+runs, when it has one, so that runs neither order hosts by the ones before
+them nor leave the fake hosts in the history of real ones.
+
+Open files and children are sampled from /proc, which makes this Linux
+only.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import select
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_REPO_DIR = os.path.dirname(_BENCH_DIR)
+_FAKE_SSH = os.path.join(_BENCH_DIR, 'fake_ssh')
+
+_DEFAULT_HOST_COUNTS = [10, 100, 1000, 10000]
+_DEFAULT_OUTPUT = 'bench_results.jsonl'
+_DEFAULT_COMMAND = 'uptime'
+_SAMPLE_INTERVAL = 0.01
+_READ_SIZE = 65536
+
+# Environment for fake_ssh, and arguments for poh, of every scenario
+_SCENARIOS = collections.OrderedDict([
+    ('baseline', ({'POH_BENCH_LINES': '1'}, [])),
+    ('latency', ({'POH_BENCH_LATENCY': '0.2', 'POH_BENCH_LINES': '10'}, [])),
+    ('volume', ({'POH_BENCH_LINES': '5000', 'POH_BENCH_WIDTH': '120'}, [])),
+    ('noise', ({'POH_BENCH_LINES': '10', 'POH_BENCH_NOISE': '1'}, [])),
+    ('failures', ({'POH_BENCH_LINES': '10', 'POH_BENCH_EXIT': '1',
+                   'POH_BENCH_FAIL_EVERY': '10'}, [])),
+    ('hangs', ({'POH_BENCH_LINES': '10', 'POH_BENCH_HANG_EVERY': '50'},
+               ['-T', '1'])),
+])
+
+def _comma_separated_ints(ints_string):
+    try:
+        return [int(int_string) for int_string in ints_string.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "{!r} is not a comma separated list of numbers".format(ints_string)
+        )
+
+def _create_argparser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__
+    )
+    add_arg = parser.add_argument
+    add_arg('-n', '--hosts', type=_comma_separated_ints,
+            default=_DEFAULT_HOST_COUNTS, metavar='N[,N...]',
+            help="Numbers of hosts to run on. (default: %(default)s)")
+    add_arg('-s', '--scenario', action='append', dest='scenarios',
+            choices=list(_SCENARIOS.keys()), default=[],
+            help="Scenario to run, all of them by default. (+)")
+    add_arg('-c', '--command', action='append', dest='commands', default=[],
+            help="Command to have poh run on the hosts. (+)"
+                 " (default: {!r})".format(_DEFAULT_COMMAND))
+    add_arg('-a', '--poh-args', default='',
+            help="Extra arguments for poh, as a single shell-quoted string,"
+                 " e.g. '-m batch -P 128'.")
+    add_arg('-R', '--relays', type=int, default=0, metavar='K',
+            help="Have poh relay through K relays, which run locally.")
+    add_arg('--poh', default=None,
+            help="Command that runs poh, as a single shell-quoted string."
+                 " (default: this repository's poh with this interpreter)")
+    add_arg('-r', '--repeat', type=int, default=1,
+            help="Number of runs of each scenario and number of hosts.")
+    add_arg('-o', '--output', default=_DEFAULT_OUTPUT,
+            help="File to append results to. (default: %(default)s)")
+    add_arg('-l', '--label', default=None,
+            help="Label to record results under, the version of poh being"
+                 " benchmarked by default.")
+    return parser
+
+def _poh_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=_REPO_DIR,
+            stderr=open(os.devnull, 'w')
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _history_args(poh_cmd, env):
+    """Arguments keeping poh from using its history, if it has one."""
+    with open(os.devnull, 'r+') as devnull:
+        proc = subprocess.Popen(poh_cmd + ['--help'], env=env, stdin=devnull,
+                                stdout=subprocess.PIPE, stderr=devnull)
+        help_text, _ = proc.communicate()
+    if b'--no-history' in help_text:
+        return ['--no-history']
+    return []
+
+def _fd_count(pid):
+    try:
+        return len(os.listdir('/proc/{}/fd'.format(pid)))
+    except OSError:
+        return 0
+
+def _children_count(pid):
+    children_path = '/proc/{0}/task/{0}/children'.format(pid)
+    try:
+        with open(children_path) as children_file:
+            return len(children_file.read().split())
+    except (IOError, OSError):
+        pass
+    # Kernels without CONFIG_PROC_CHILDREN, look for them by their parent
+    count = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as stat_file:
+                stat = stat_file.read()
+        except (IOError, OSError):
+            continue
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            count += 1
+    return count
+
+def _run_once(poh_cmd, hosts, commands, env):
+    """Run poh once and measure it."""
+    devnull = open(os.devnull, 'w')
+    start_time = time.time()
+    proc = subprocess.Popen(poh_cmd + ['--'] + commands, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=devnull)
+    proc.stdin.write(''.join(host + '\n' for host in hosts).encode())
+    proc.stdin.close()
+
+    first_output_time = None
+    output_bytes = 0
+    max_fds = max_children = 0
+    stdout_fd = proc.stdout.fileno()
+    while True:
+        readable, _, _ = select.select([stdout_fd], [], [], _SAMPLE_INTERVAL)
+        if readable:
+            data = os.read(stdout_fd, _READ_SIZE)
+            if not data:
+                break
+            if first_output_time is None:
+                first_output_time = time.time()
+            output_bytes += len(data)
+        max_fds = max(max_fds, _fd_count(proc.pid))
+        max_children = max(max_children, _children_count(proc.pid))
+
+    # wait4 gives the peak RSS of poh itself, its children are much smaller
+    _, status, rusage = os.wait4(proc.pid, 0)
+    end_time = time.time()
+    proc.returncode = os.WEXITSTATUS(status)
+    proc.stdout.close()
+    devnull.close()
+
+    peak_rss_kb = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss_kb //= 1024
+    return collections.OrderedDict([
+        ('returncode', proc.returncode),
+        ('wall_time', end_time - start_time),
+        ('time_to_first_output', None if first_output_time is None
+                                 else first_output_time - start_time),
+        ('peak_rss_kb', peak_rss_kb),
+        ('max_fds', max_fds),
+        ('max_children', max_children),
+        ('output_bytes', output_bytes),
+    ])
+
+def _summary_line(record):
+    time_to_first_output = record['time_to_first_output']
+    if time_to_first_output is None:
+        time_to_first_output = float('nan')
+    return ("{scenario:10s} {hosts:6d} hosts  rc={returncode:<3d}"
+            " wall={wall_time:8.3f}s ttfo={ttfo:8.3f}s"
+            " rss={peak_rss_kb:7d}KiB fds={max_fds:5d}"
+            " children={max_children:5d}").format(ttfo=time_to_first_output,
+                                                  **record)
+
+def main():
+    args = _create_argparser().parse_args()
+    scenarios = args.scenarios or list(_SCENARIOS.keys())
+    commands = args.commands or [_DEFAULT_COMMAND]
+    poh_args = shlex.split(args.poh_args)
+    if args.relays:
+        poh_args.append('--relays')
+        poh_args.extend('relay{}'.format(num)
+                        for num in range(1, args.relays + 1))
+    if args.poh is not None:
+        poh_cmd = shlex.split(args.poh)
+    else:
+        poh_cmd = [sys.executable, '-m', 'poh']
+    label = args.label or _poh_version()
+
+    env = dict(os.environ)
+    python_path = [_REPO_DIR]
+    if env.get('PYTHONPATH'):
+        python_path.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(python_path)
+    # Kept apart from poh_args, runs of versions with and without a
+    # history are still the same runs to compare_bench.py
+    harness_args = _history_args(poh_cmd, env)
+
+    fake_bin_dir = tempfile.mkdtemp(prefix='poh-bench-')
+    os.symlink(_FAKE_SSH, os.path.join(fake_bin_dir, 'ssh'))
+    try:
+        with open(args.output, 'a') as output_file:
+            for scenario in scenarios:
+                fake_env, scenario_args = _SCENARIOS[scenario]
+                scenario_env = dict(env)
+                scenario_env.update(fake_env)
+                scenario_env['PATH'] = os.pathsep.join([fake_bin_dir,
+                                                        env['PATH']])
+                for num_hosts in args.hosts:
+                    hosts = ['host{:05d}'.format(num)
+                             for num in range(1, num_hosts + 1)]
+                    for _ in range(args.repeat):
+                        measures = _run_once(
+                            poh_cmd + scenario_args + poh_args +
+                            harness_args, hosts,
+                            commands, scenario_env
+                        )
+                        record = collections.OrderedDict([
+                            ('label', label),
+                            ('timestamp', time.time()),
+                            ('python', sys.version.split()[0]),
+                            ('scenario', scenario),
+                            ('hosts', num_hosts),
+                            ('commands', commands),
+                            ('poh_args', scenario_args + poh_args),
+                            ('harness_args', harness_args),
+                            ('fake_ssh', fake_env),
+                        ])
+                        record.update(measures)
+                        output_file.write(json.dumps(record) + '\n')
+                        output_file.flush()
+                        print(_summary_line(record))
+                        sys.stdout.flush()
+    finally:
+        shutil.rmtree(fake_bin_dir)
+
+if __name__ == '__main__':
+    main()
@@ -5,58 +5,78 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import argparse
+# Only modules that are cheap, or needed by anything poh does, are imported
+# here. The rest are imported where they're used, so that -V, -D and
+# library use don't pay for what they don't use (see bench/import_time.py)
+import array
+import codecs
 import collections
-import datetime
 import errno
-import fcntl
+import io
 import itertools
-import logging
+import math
 import operator
 import os
-import shlex
-import shutil
-import struct
-import subprocess
 import sys
-import tempfile
-import textwrap
 import time
 import re
 
-import poh
+try:
+    from poh import __versionstr__
+except ImportError:
+    # Run as a single file, as on relays, without the package around it
+    __versionstr__ = 'unknown'
 
-import termios
+try:
+    from collections.abc import Mapping as _Mapping
+except ImportError:
+    # python2 keeps it in collections
+    from collections import Mapping as _Mapping
 
 _CMD_EPILOG = """\
 (+) means that the option may be specified multiple times
 
 Additional servers will be read one per line if '-' is present in the
 server list specified in the command line or stdin is not a terminal
-(as when being piped the output of another command).
+(as when being piped the output of another command). Each server is run
+on once, in the order they were given or, when there's a history of
+earlier runs (see --history-file), those expected to take longest first.
+Until a server with a history comes up commands start running on the first
+servers while the rest are still being read.
 
 When reading stdin or files, lines starting with '#' will be ignored.
 
+Servers may be given as patterns with numbers or ranges of numbers in
+brackets, as in web[001-500].dc[1-3] or db[1,4-6], which stand for every
+combination of them. Numbers keep the zero padding of a range's start, and
+ranges like [10-1] go down.
+
 Notes on option presedence:
 * -q implies --no-color
 * -1 (dash-one), -L, and -W are ignored if -r or -q are specified.
 * -L is ignored if -1 (dash-one) is specified.
+* -t is ignored if -s is specified.
 """
 
 __MODULENAME = 'poh' if __name__ == '__main__' else __name__.rsplit('.', 1)[-1]
-LOG = logging.getLogger(__MODULENAME)
-logging.basicConfig(datefmt='%Y-%m-%dT%H:%M:%S',
-                    format='%(asctime)s.%(msecs)d - %(levelname)-8s - '
-                           '%(filename)s:%(lineno)-4d - '
-                           '%(module)s:%(funcName)s - %(message)s')
-
-_EASY_LOGGING_LEVELS = [
-    ('DEBUG', logging.DEBUG,),
-    ('INFO', logging.INFO,),
-    ('WARNING', logging.WARNING,),
-    ('ERROR', logging.ERROR,),
-    ('CRITICAL', logging.CRITICAL,),
-]
+_LOGGER_NAME = __MODULENAME
+
+class _LazyLogger(object):
+    """Stand-in for the module's logger until something gets logged.
+
+    Looking anything up on it imports logging and puts the actual logger in
+    its place.
+    """
+
+    def __getattr__(self, name):
+        global LOG
+        import logging
+        LOG = logging.getLogger(_LOGGER_NAME)
+        return getattr(LOG, name)
+
+LOG = _LazyLogger()
+
+_EASY_LOGGING_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 _MAX_LOGLVL = len(_EASY_LOGGING_LEVELS)
 
 _PRETTY_ARGUMENTS_FORMAT = """\
@@ -65,15 +85,38 @@ debug = {debug!r}
 dry_run = {dry_run!r}
 verbosity = {verbosity!r}
 output_dir = {output_dir!r}
+resume = {resume!r}
 keep_output = {keep_output!r}
+pack_output = {pack_output!r}
+compress_output = {compress_output!r}
 transpose_output = {transpose_output!r} 
+group_output = {group_output!r}
 quiet_output = {quiet_output!r}
 raw_output = {raw_output!r}
 one_line = {one_line!r}
 long_output = {long_output!r}
 wide_output = {wide_output!r}
+max_parallel = {max_parallel!r}
+exec_mode = {exec_mode!r}
+control_master = {control_master!r}
+control_persist = {control_persist!r}
+timeout = {timeout!r}
+run_timeout = {run_timeout!r}
+retries = {retries!r}
+retry_budget = {retry_budget!r}
+retry_backoff = {retry_backoff!r}
+rolling = {rolling!r}
+max_failures = {max_failures!r}
+relays = {relays!r}
+sync = {sync!r}
+json_output = {json_output!r}
+summary = {summary!r}
+metrics_file = {metrics_file!r}
+metrics_format = {metrics_format!r}
+history_file = {history_file!r}
 ssh_config = {ssh_config!r}
 servers: {servers}
+hosts_files: {hosts_files}
 cmd_files: {cmd_files}
 positional_was_first: {positional_was_first}
 commands (only showing printable chars): {commands}
@@ -88,18 +131,6 @@ To not show this warning set the environment variable POH_IGNORE_PY2_WARNS to
 something other than the string 'no'.
 """
 
-_MESSAGE_WRAPPER = textwrap.TextWrapper()
-_MESSAGE_WRAPPER.expand_tabs = False
-_MESSAGE_WRAPPER.replace_whitespace = False
-_MESSAGE_WRAPPER.drop_whitespace = False
-
-_ERROR_WRAPPER = textwrap.TextWrapper()
-_ERROR_WRAPPER.expand_tabs = False
-_ERROR_WRAPPER.replace_whitespace = False
-_ERROR_WRAPPER.drop_whitespace = False
-_ERROR_WRAPPER.subsequent_indent = '       '
-_ERROR_WRAPPER.initial_indent = '       '
-
 _ESC_CODE_FMT = '\x1b[{}m'
 
 _COLORS = {
@@ -119,14 +150,84 @@ _CODES = {
     'fg_reset': 39,
     'bg_reset': 49,
 }
-_CODES.update({
-    'fg_{}'.format(color): code+30
-    for color, code in _COLORS.items()
-})
-_CODES.update({
-    'bg_{}'.format(color): code+40
-    for color, code in _COLORS.items()
-})
+# Codes of the colors are their number added to that of the layer
+_LAYER_CODES = {
+    'fg': 30,
+    'bg': 40,
+}
+
+_DEFAULT_MAX_PARALLEL = 64
+_POLL_INTERVAL = 0.01
+_DEFAULT_EXEC_MODE = 'parallel'
+_PERSISTENT_CONTROL_DIR = os.path.join('~', '.poh', 'control')
+_DEFAULT_HISTORY_FILE = os.path.join('~', '.poh', 'history.json')
+_KILL_GRACE = 2.0
+_DEFAULT_RETRY_BACKOFF = 1.0
+_RELAY_GRACE = 10.0
+_RETRY_BACKOFF_CAP = 30.0
+_READ_SIZE = 65536
+_SPILL_THRESHOLD = 1 << 20
+# sha1 of nothing
+_EMPTY_DIGEST = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+_WRITE_BUFFER_SIZE = 65536
+_MANIFEST_FILENAME = 'poh.manifest'
+_PACK_FILENAME = 'poh.pack'
+
+_SLOWEST_JOBS = 10
+_PERCENTILES = (50, 95, 99,)
+_DEFAULT_METRICS_FORMAT = 'json'
+_HISTORY_WEIGHT = 0.3
+_HISTORY_MIN_RUNS = 3
+_HISTORY_MAX_AGE = 30 * 24 * 60 * 60
+_HISTORY_MAX_SERVERS = 10000
+_HISTORY_CMDS_PER_SERVER = 8
+_REGRESSION_FACTOR = 2.0
+_REGRESSION_MIN_SECONDS = 1.0
+
+_SERVER_RANGES_RE = re.compile(r'\[(\d+(?:-\d+)?(?:,\d+(?:-\d+)?)*)\]')
+_SERVER_SEPARATOR_RE = re.compile(r',(?![^\[\]]*\])')
+
+# What ssh writes to stderr when it can't get a session with the server
+_SSH_CONNECT_ERROR_RE = re.compile(
+    r'^(?:ssh: connect to host |ssh: Could not resolve hostname |'
+    r'kex_exchange_identification: |ssh_exchange_identification: |'
+    r'Connection (?:closed|reset|timed out) by )', re.MULTILINE
+)
+# Lines at the end of stderr to look for them in
+_SSH_ERROR_LINES = 5
+
+# Strings decoded from JSON, unicode on python2
+_TEXT_TYPE = type(u'')
+# Characters of a line relays shouldn't have reported that are logged
+_REPORTED_LINE_CHARS = 200
+
+_STATUS_TIMEOUT = 'TIMEOUT'
+_STATUS_SKIPPED = 'SKIPPED'
+_STATUS_UNREPORTED = 'UNREPORTED'
+_STATUSES = (_STATUS_TIMEOUT, _STATUS_SKIPPED, _STATUS_UNREPORTED,)
+_STATUS_ABBREVIATIONS = {
+    _STATUS_TIMEOUT: 'TO',
+    _STATUS_SKIPPED: 'SK',
+    _STATUS_UNREPORTED: 'UR',
+}
+
+_BATCH_CMD_FORMAT = """\
+printf '%s begin %d\\n' {marker} {cmd_num}
+printf '%s begin %d\\n' {marker} {cmd_num} >&2
+"${{SHELL:-/bin/sh}}" -c {quoted_cmd} </dev/null
+printf '\\n%s end %d %d\\n' {marker} {cmd_num} "$?"
+printf '\\n%s end %d\\n' {marker} {cmd_num} >&2
+"""
+
+# Run by python on relays, reads poh's source preceded by its number of lines
+# from stdin and runs it, leaving the rest of stdin for it to read
+_RELAY_BOOTSTRAP = (
+    "import sys; "
+    "read = sys.stdin.readline; "
+    "source = ''.join([read() for _ in range(int(read()))]); "
+    "sys.argv[0] = 'poh'; "
+    "exec(compile(source, 'poh.py', 'exec'), {'__name__': '__main__'})"
+)
 
 _TIME_HEADER_FORMAT = """\
   Start time = {start_local} {tz_name} ({start_utc} UTC)
@@ -140,6 +241,12 @@ _TIME_HEADER_FORMAT_WITH_COLOR = """\
 \x1b[34mElapsed time\x1b[39m \x1b[30m=\x1b[0m {elapsed:0.3f}s
 """
 
+def _escape_code(code_string):
+    if code_string in _CODES:
+        return _CODES[code_string]
+    layer, _, color = code_string.partition('_')
+    return _LAYER_CODES[layer] + _COLORS[color]
+
 def _escaped_with(original_string, pre=None, post=None):
     if pre is None and post is None:
         return original_string
@@ -147,7 +254,7 @@ def _escaped_with(original_string, pre=None, post=None):
     escaped_string = ''
 
     if pre is not None:
-        pre_codes = [str(_CODES[code_string]) for code_string in pre]
+        pre_codes = [str(_escape_code(code_string)) for code_string in pre]
         escaped_string += _ESC_CODE_FMT.format(';'.join(pre_codes))
 
         if post is None:
@@ -156,12 +263,17 @@ def _escaped_with(original_string, pre=None, post=None):
     escaped_string += original_string
 
     if post is not None:
-        post_codes = [str(_CODES[code_string]) for code_string in post]
+        post_codes = [str(_escape_code(code_string)) for code_string in post]
         escaped_string += _ESC_CODE_FMT.format(';'.join(post_codes))
 
     return escaped_string
 
 def _get_terminal_size(file_descriptor_num):
+    import fcntl
+    import shutil
+    import struct
+    import termios
+
     try:
         term_columns, term_lines = shutil.get_terminal_size()
     except AttributeError:
@@ -205,6 +317,11 @@ def _get_terminal_size(file_descriptor_num):
     return term_columns, term_lines
 
 def _set_rootlogger_verbosity(verbosity):
+    import logging
+    logging.basicConfig(datefmt='%Y-%m-%dT%H:%M:%S',
+                        format='%(asctime)s.%(msecs)d - %(levelname)-8s - '
+                               '%(filename)s:%(lineno)-4d - '
+                               '%(module)s:%(funcName)s - %(message)s')
     rootlogger = logging.getLogger('')
     default_level = 3
 
@@ -214,19 +331,25 @@ def _set_rootlogger_verbosity(verbosity):
     elif desired_level > len(_EASY_LOGGING_LEVELS) - 1:
         desired_level = -1
 
-    level_name, level_num = _EASY_LOGGING_LEVELS[desired_level]
-    rootlogger.setLevel(level_num)
+    level_name = _EASY_LOGGING_LEVELS[desired_level]
+    rootlogger.setLevel(getattr(logging, level_name))
     LOG.info('Set logging level on root logger to %s', level_name)
 
+def _message_wrapper(indent=''):
+    import textwrap
+    return textwrap.TextWrapper(expand_tabs=False, replace_whitespace=False,
+                                drop_whitespace=False, initial_indent=indent,
+                                subsequent_indent=indent)
+
 def _show_on_stderr(message, error=False):
-    message_wrapper = _MESSAGE_WRAPPER
+    message_wrapper = _message_wrapper()
 
     paragraphs = message.splitlines()
 
     first_par = None
     if error and len(paragraphs) > 0:
-        message_wrapper = _ERROR_WRAPPER
-        first_par = _MESSAGE_WRAPPER.fill("Error: " + paragraphs.pop(0))
+        first_par = message_wrapper.fill("Error: " + paragraphs.pop(0))
+        message_wrapper = _message_wrapper('       ')
 
     formatted_paragraphs = [message_wrapper.fill(par) for par in paragraphs]
     if first_par is not None:
@@ -247,6 +370,7 @@ def _show_error_messages(msgs_list):
         _show_on_stderr(msg+'\n', error=True)
 
 def _potential_dir(path_string):
+    import argparse
     absolute_path = os.path.abspath(path_string)
 
     if os.path.isdir(absolute_path):
@@ -267,19 +391,134 @@ def _potential_dir(path_string):
     else:
         return absolute_path
 
+def _existing_dir(path_string):
+    import argparse
+    absolute_path = os.path.abspath(path_string)
+    if not os.path.isdir(absolute_path):
+        message = "{!r} is not a directory.".format(path_string)
+        raise argparse.ArgumentTypeError(message)
+    return absolute_path
+
+def _non_negative_number(number_string, number_type, type_name):
+    import argparse
+    try:
+        number = number_type(number_string)
+    except ValueError:
+        number = -1
+    if number < 0:
+        message = "{!r} is not a non-negative {}.".format(number_string,
+                                                          type_name)
+        raise argparse.ArgumentTypeError(message)
+    return number
+
+def _non_negative_int(int_string):
+    return _non_negative_number(int_string, int, 'integer')
+
+def _non_negative_float(float_string):
+    return _non_negative_number(float_string, float, 'number')
+
+def _servers_spec(spec_string):
+    """A number of servers, or a percentage of them if it ends with '%'."""
+    if spec_string.endswith('%'):
+        _non_negative_float(spec_string[:-1])
+    else:
+        _non_negative_int(spec_string)
+    return spec_string
+
+def _servers_count(servers_spec, num_servers):
+    """How many of ``num_servers`` servers ``servers_spec`` stands for."""
+    servers_spec = str(servers_spec)
+    if servers_spec.endswith('%'):
+        return num_servers * float(servers_spec[:-1]) / 100
+    return int(servers_spec)
+
+def _range_items(ranges_string):
+    for range_string in ranges_string.split(','):
+        first, _, last = range_string.partition('-')
+        width = len(first) if first.startswith('0') else 0
+        start, end = int(first), int(last or first)
+        # Ranges that go down are expanded going down
+        step = 1 if start <= end else -1
+        for number in range(start, end + step, step):
+            yield str(number).zfill(width)
+
+def _expanded_servers(pattern):
+    """Servers a pattern stands for, expanded as they're asked for.
+
+    Every [...] holding numbers or ranges of numbers, like [1-3,7], stands
+    for each of them in turn, and combinations of several are expanded
+    with the leftmost one changing slowest.
+    """
+    match = _SERVER_RANGES_RE.search(pattern)
+    if match is None:
+        yield pattern
+        return
+    prefix, rest = pattern[:match.start()], pattern[match.end():]
+    for item in _range_items(match.group(1)):
+        for expanded_rest in _expanded_servers(rest):
+            yield prefix + item + expanded_rest
+
+def _server_patterns(server_lists):
+    for patterns in itertools.chain(*server_lists):
+        # Commas separate servers, except within brackets
+        for pattern in _SERVER_SEPARATOR_RE.split(patterns):
+            if pattern:
+                yield pattern
+
 def _get_servers(server_lists):
-    for server in itertools.chain(*server_lists):
-        if ',' in server:
-            for serv in server.split(','):
-                yield serv
-            # The proper idiom in python3 is the "yield from" below
-            # Kept from...yield  for python2 compat
-            # yield from server.split(',')
-        else:
+    for pattern in _server_patterns(server_lists):
+        for server in _expanded_servers(pattern):
+            yield server
+
+def _inventory_lines(inventory_file):
+    """Patterns of servers in a file, read a line at a time."""
+    for line in iter(inventory_file.readline, ''):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+class _SeenServers(object):
+    """Servers already run on, known by a 64 bit digest of their name.
+
+    A digest takes a fraction of the memory a name does in a set, and two
+    names sharing one is unlikely enough even among millions of them that
+    it isn't checked for.
+    """
+
+    __slots__ = ('digests',)
+
+    def __init__(self):
+        self.digests = set()
+
+    def add(self, server):
+        """Add ``server``, returning whether it wasn't there already."""
+        import hashlib
+        digest = int(hashlib.sha1(server.encode('utf-8')).hexdigest()[:16],
+                     16)
+        if digest in self.digests:
+            return False
+        self.digests.add(digest)
+        return True
+
+def _server_inventory(server_lists, hosts_files=(), stdin=None):
+    """Servers to run on, each of them once in the order they're given.
+
+    Servers in the command line come first, then those in ``hosts_files``
+    and in ``stdin``, which are only read as more servers are needed so
+    that commands start running on the first ones in the meantime.
+    """
+    sources = [[pattern for pattern in _server_patterns(server_lists)
+                if pattern != '-']]
+    sources.extend(_inventory_lines(hosts_file) for hosts_file in hosts_files)
+    if stdin is not None:
+        sources.append(_inventory_lines(stdin))
+
+    seen_servers = _SeenServers()
+    for server in _get_servers(sources):
+        if seen_servers.add(server):
             yield server
 
 def _printable_string(original_string):
-    import codecs
     escaped_repr = repr(codecs.encode(original_string, 'utf-8'))
     escaped_string = escaped_repr[escaped_repr.index("'")+1:-1]
     escaped_string = escaped_string.replace("\\\\", "\\")
@@ -297,8 +536,17 @@ def _prettified_args(args_dict):
         pretty_dict['cmd_files'] = ''.join(['\n    - {}'.format(f.name)
                                             for f in pretty_dict['cmd_files']])
 
-    pretty_dict['servers'] = ''.join(['\n    - {}'.format(s)
-                                      for s in pretty_dict['servers']])
+    if not pretty_dict['hosts_files']:
+        pretty_dict['hosts_files'] = 'None'
+    else:
+        pretty_dict['hosts_files'] = ''.join([
+            '\n    - {}'.format(f.name) for f in pretty_dict['hosts_files']
+        ])
+
+    pretty_dict['servers'] = ''.join([
+        '\n    - {}'.format(s)
+        for s in itertools.chain(*pretty_dict['servers'])
+    ])
 
     commands_dict = pretty_dict.pop('commands')
 
@@ -321,12 +569,11 @@ def _prettified_args(args_dict):
     return pretty_arguments
 
 def _create_argparser():
+    import argparse
     # TODO: add an option to upload an sh and execute it instead
     #       of a command_file or a command
     # TODO: add --ssh-args for passing arbitrary stuff to ssh
-    # TODO: add a --synch to print results as they arrive
     # TODO: change --transpose to make execution order be transposed as well?
-    # TODO: add a --timeout
     parser = argparse.ArgumentParser(
         prog=__MODULENAME,
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -334,7 +581,7 @@ def _create_argparser():
     )
     add_arg = parser.add_argument
     add_arg('-V', '--version', action='version',
-            version='{} v{}'.format(__MODULENAME, poh.__versionstr__),
+            version='{} v{}'.format(__MODULENAME, __versionstr__),
             help="Show version string and exit")
     add_arg('-x', '--debug', action='store_true',
             help="Include debugging information. (implies maximum verbosity)")
@@ -344,6 +591,12 @@ def _create_argparser():
             help="Disable colored output. Automatic if stdout is not a term")
     add_arg('-t', '--transpose-output', action='store_true',
             help="Print outputs grouped by commands. (default is by server)")
+    add_arg('-g', '--group-output', '--dedup', action='store_true',
+            help="Print each distinct result of a command (return value,"
+                 " stdout and stderr) once, along with the servers that got"
+                 " it, rather than once per server. Without -t, servers"
+                 " that got the same results for all commands are grouped"
+                 " together. Ignored with -1, -r, -q, -s and -j.")
     add_arg('-1', '--one-line', action='store_true',
             help="(dash-one) Print only the first line of output of the first"
                  " command right after a summary of return codes for all"
@@ -362,8 +615,27 @@ def _create_argparser():
             help="Keep temp files (stdout, stderr, and retval) of commands")
     add_arg('-o', '--output-dir', action='store', default=None,
             help="Directory for temp files. (implies -k)", type=_potential_dir)
+    add_arg('--resume', action='store', metavar='DIR', default=None,
+            type=_existing_dir,
+            help="Run again only the commands that failed, or have no"
+                 " result, in the output directory DIR of an earlier run,"
+                 " adding their results to it and reporting all of them."
+                 " Servers default to those with results in DIR, commands"
+                 " have to be the same as in that run, or it isn't resumed."
+                 " (implies -o DIR)")
+    add_arg('--pack', action='store_true', dest='pack_output',
+            help="Keep the outputs of all commands packed in a single file"
+                 " of the output directory, indexed by its manifest, rather"
+                 " than in a file per output. (with -k or -o)")
+    add_arg('-z', '--compress', action='store_true', dest='compress_output',
+            help="Compress each output kept in the pack. (implies --pack)")
     add_arg('-S', '--servers', metavar='SERVER', nargs='+', action='append',
             help="Servers to run commands on. (+)", dest='servers', default=[])
+    add_arg('-H', '--hosts-from', action='append', default=[],
+            type=argparse.FileType(), dest='hosts_files',
+            metavar='HOSTS_FILE',
+            help="Load servers from the file specified, one or more per"
+                 " line. (+)")
     add_arg('-F', '--ssh-config', action='store', default=None,
             type=argparse.FileType(),
             help="Use the ssh configuration in the specified file."
@@ -383,10 +655,128 @@ def _create_argparser():
                  " (a colon, and a tab character)")
     add_arg('-q', '--quiet-output', action='store_true',
             help="Same as '-r/--raw-output' but without server name prefix")
+    add_arg('-s', '--sync', '--live', action='store_true',
+            help="Print the results of each command as soon as it finishes"
+                 " instead of all of them at the end of the run. With -r or"
+                 " -q lines of output are forwarded as they arrive.")
+    add_arg('-j', '--json', '--jsonl', action='store_true',
+            dest='json_output',
+            help="Write a line of JSON for every command as soon as it"
+                 " finishes, with server, command number, command, return"
+                 " value, stdout, stderr, their line counts, and timings of"
+                 " the ssh session. Other output options are ignored.")
+    add_arg('-P', '--max-parallel', action='store', metavar='NUM',
+            default=_DEFAULT_MAX_PARALLEL, type=_non_negative_int,
+            help="Run at most NUM ssh processes at the same time, starting"
+                 " the next one as soon as one finishes. 0 means no limit."
+                 " (default: %(default)s)")
+    add_arg('-m', '--exec-mode', action='store', default=_DEFAULT_EXEC_MODE,
+            choices=list(_LANE_BUILDERS.keys()),
+            help="How commands are run on each server. 'parallel' runs every"
+                 " command as its own concurrent ssh session. 'pipeline' runs"
+                 " the commands of a server one after the other, in order,"
+                 " using one slot per server while servers still run in"
+                 " parallel. 'batch' is like 'pipeline' but sends all the"
+                 " commands of a server through a single ssh session, which"
+                 " needs a POSIX sh on the servers. (default: %(default)s)")
+    add_arg('-M', '--control-master', action='store_true',
+            help="Open one OpenSSH control master connection per server"
+                 " before running commands and multiplex all the ssh"
+                 " sessions to that server over it. Servers whose master"
+                 " can't be opened, or takes longer than -T to, are"
+                 " connected to directly.")
+    add_arg('--control-persist', action='store', metavar='SECONDS',
+            default=0, type=_non_negative_int,
+            help="Leave control masters open for SECONDS without sessions"
+                 " after the run, so that runs within that window reuse"
+                 " them. Their sockets are kept in {} rather than in the"
+                 " output directory. (implies -M)"
+                 " (default: %(default)s)".format(_PERSISTENT_CONTROL_DIR))
+    add_arg('-T', '--timeout', action='store', metavar='SECONDS',
+            default=None, type=_non_negative_float,
+            help="Terminate ssh sessions that run for longer than SECONDS,"
+                 " and kill them if they don't exit shortly after. Their"
+                 " result is shown as TIMEOUT along with any output they"
+                 " produced. In batch mode this applies to the whole"
+                 " session of a server.")
+    add_arg('--run-timeout', action='store', metavar='SECONDS',
+            default=None, type=_non_negative_float,
+            help="Stop the whole run after SECONDS, timing out the ssh"
+                 " sessions still running and the ones that didn't get to"
+                 " start. Results of the finished ones are shown as usual.")
+    add_arg('-R', '--retries', action='store', metavar='NUM', default=0,
+            type=_non_negative_int,
+            help="Run commands again up to NUM times when ssh fails to"
+                 " connect (exits with 255 without any output on stdout,"
+                 " having said on stderr that it couldn't connect or"
+                 " resolve the host), waiting a random time that doubles"
+                 " on every attempt. Commands that exit with 255 on their"
+                 " own aren't run again."
+                 " The number of attempts is shown with the results."
+                 " (default: %(default)s)")
+    add_arg('--retry-budget', action='store', metavar='NUM', default=None,
+            type=_non_negative_int,
+            help="Make at most NUM retries in the whole run."
+                 " (default: no limit)")
+    add_arg('--retry-backoff', action='store', metavar='SECONDS',
+            default=_DEFAULT_RETRY_BACKOFF, type=_non_negative_float,
+            help="Longest wait before the first retry, doubling for every"
+                 " one after it up to {:g}s. (default: %(default)s)".format(
+                     _RETRY_BACKOFF_CAP
+                 ))
+    add_arg('--rolling', action='store', metavar='SIZE', default=None,
+            type=_servers_spec,
+            help="Run on the servers in batches of SIZE servers, or SIZE"
+                 " percent of them if followed by '%%', starting each batch"
+                 " once the one before is done.")
+    add_arg('--max-failures', action='store', metavar='NUM', default='0',
+            type=_servers_spec,
+            help="With --rolling, don't start another batch once commands"
+                 " failed on more than NUM servers, or NUM percent of them"
+                 " if followed by '%%'. Results of servers left out are"
+                 " shown as SKIPPED. (default: %(default)s)")
+    add_arg('--relays', metavar='RELAY', nargs='+', action='append',
+            default=[],
+            help="Split the servers among RELAYs, have each of them run"
+                 " the commands on its share with a copy of poh sent over"
+                 " ssh, and collect what they got. Relays need python and"
+                 " ssh access to their servers, options for running"
+                 " commands are passed on to them. Results are shown as"
+                 " UNREPORTED for commands a relay didn't report. (+)")
+    add_arg('--history-file', action='store', metavar='FILE',
+            default=os.path.expanduser(_DEFAULT_HISTORY_FILE),
+            help="Keep how long commands took on every server in FILE,"
+                 " start those expected to take longest first, and point out"
+                 " the ones that took much longer than usual after the"
+                 " results. Only the last {} commands of the last {} servers"
+                 " run in the last {} days are kept. (default: {})".format(
+                     _HISTORY_CMDS_PER_SERVER, _HISTORY_MAX_SERVERS,
+                     _HISTORY_MAX_AGE // (24 * 60 * 60),
+                     _DEFAULT_HISTORY_FILE
+                 ))
+    add_arg('--no-history', action='store_const', const=None,
+            dest='history_file',
+            help="Neither use nor keep the history of earlier runs.")
+    add_arg('--summary', action='store_true',
+            help="Show a summary of the timing of ssh sessions after the"
+                 " results: latency percentiles, slowest sessions,"
+                 " concurrency and output captured. (on stderr with -r or"
+                 " -q)")
+    add_arg('--metrics-file', action='store', metavar='FILE', default=None,
+            help="Write the timing of every ssh session (spawn, first"
+                 " output, exit and reap) and the aggregates of the summary"
+                 " to FILE.")
+    add_arg('--metrics-format', action='store',
+            default=_DEFAULT_METRICS_FORMAT,
+            choices=list(_METRICS_FORMATTERS.keys()),
+            help="Format of the metrics file, 'prometheus' is meant for the"
+                 " textfile collector of node_exporter."
+                 " (default: %(default)s)")
 
     return parser
 
 def _read_commands_files(commands_files):
+    import shlex
     commands_dictionary = collections.OrderedDict()
 
     for commands_file in commands_files:
@@ -416,6 +806,7 @@ def _read_commands_files(commands_files):
     return commands_dictionary
 
 def _remove_output_dir(output_dir):
+    import shutil
     try:
         error_out_on_remove = not shutil.rmtree.avoids_symlink_attacks
     except AttributeError:
@@ -441,6 +832,22 @@ def _remove_output_dir(output_dir):
         LOG.debug("Removing output directory at %r.", output_dir)
         shutil.rmtree(output_dir)
 
+class _TemporaryOutputDir(object):
+    """Temporary output directory, removed once nothing refers to it.
+
+    Outputs that spilled into it hold on to it, so that it outlives them.
+    """
+
+    __slots__ = ('path',)
+
+    def __init__(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+        LOG.debug("Created temporary directory at %r.", self.path)
+
+    def __del__(self):
+        _remove_output_dir(self.path)
+
 def _count_lines(filepath):
     num_line = 0
     with open(filepath, 'r') as input_file:
@@ -455,12 +862,6 @@ def _read_one_line(filepath):
         first_line = input_file.readline()
     return first_line
 
-def _read_entire_file(filepath):
-    file_contents = None
-    with open(filepath, 'r') as input_file:
-        file_contents = input_file.read()
-    return file_contents
-
 def _read_int_from_file(filepath):
     try:
         number = int(_read_one_line(filepath))
@@ -470,69 +871,918 @@ def _read_int_from_file(filepath):
         number = -1
     return number
 
-def read_result_files(output_dir, one_line=False):
-    results = {}
-    total_lines = 0
+def _read_retval_from_file(filepath):
+    retval_string = _read_one_line(filepath).strip()
+    if retval_string in _STATUSES:
+        return retval_string
+    return _read_int_from_file(filepath)
+
+_CmdResult = collections.namedtuple('_CmdResult', [
+    'server', 'cmd_num', 'retval', 'stdout', 'stderr', 'attempts',
+])
+
+def _line_count_of(data):
+    line_count = data.count(b'\n')
+    if data and not data.endswith(b'\n'):
+        line_count += 1
+    return line_count
+
+def _tail_start(data, num_lines):
+    """Index in ``data`` where its last ``num_lines`` lines start."""
+    position = len(data)
+    if data.endswith(b'\n'):
+        position -= 1
+    for _ in range(num_lines):
+        position = data.rfind(b'\n', 0, position)
+        if position < 0:
+            return 0
+    return position + 1
+
+def _read_tail(filepath, num_lines, line_count=None, start=0, end=None):
+    """Last ``num_lines`` lines of a file and the number of lines in it.
+
+    The last lines are found reading the file backwards one block at a
+    time, and the rest of it is only read to count newlines in it, which
+    keeps memory use bounded by the size of the tail no matter the size of
+    the file. If ``line_count`` is given it isn't counted again. Only the
+    part of the file from ``start`` to ``end`` is read if they are given.
+    """
+    with open(filepath, 'rb') as input_file:
+        if end is None:
+            input_file.seek(0, os.SEEK_END)
+            end = input_file.tell()
+        position = end
+        # Blocks are joined once all that's needed has been read, as
+        # prepending each one to the rest would copy them over and over
+        blocks = []
+        newlines = 0
+        while position > start and newlines <= num_lines:
+            block_size = min(_READ_SIZE, position - start)
+            position -= block_size
+            input_file.seek(position)
+            block = input_file.read(block_size)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+        tail = b''.join(reversed(blocks))
+
+        if line_count is None:
+            line_count = _line_count_of(tail)
+            input_file.seek(start)
+            unread = position - start
+            while unread > 0:
+                block = input_file.read(min(_READ_SIZE, unread))
+                unread -= len(block)
+                line_count += block.count(b'\n')
+
+    tail = tail[_tail_start(tail, num_lines):]
+    return tail.decode('utf-8', 'replace'), line_count
+
+class _FileOutput(object):
+    """Output of one stream of a command, as found in a result file.
+
+    Its size and line count are only looked up in the file if they aren't
+    known beforehand.
+    """
+
+    __slots__ = ('path', 'known_size', 'known_line_count')
+
+    def __init__(self, path, size=None, line_count=None):
+        self.path = path
+        self.known_size = size
+        self.known_line_count = line_count
+
+    @property
+    def size(self):
+        if self.known_size is not None:
+            return self.known_size
+        return os.stat(self.path).st_size
+
+    @property
+    def line_count(self):
+        if self.known_line_count is not None:
+            return self.known_line_count
+        return _count_lines(self.path)
+
+    def read(self):
+        """Contents and number of lines of the file, in a single pass."""
+        with open(self.path, 'rb') as input_file:
+            data = input_file.read()
+        return data.decode('utf-8', 'replace'), _line_count_of(data)
+
+    def text(self):
+        return self.read()[0]
+
+    def tail(self, num_lines):
+        """Last ``num_lines`` lines and the number of lines of the file."""
+        return _read_tail(self.path, num_lines, self.known_line_count)
+
+    def first_line(self):
+        with open(self.path, 'rb') as input_file:
+            return input_file.readline().decode('utf-8', 'replace')
+
+    def iter_lines(self):
+        with io.open(self.path, 'r', encoding='utf-8',
+                     errors='replace') as input_file:
+            for line in input_file:
+                yield line
+
+    def digest(self):
+        import hashlib
+        output_hash = hashlib.sha1()
+        with open(self.path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(_READ_SIZE), b''):
+                output_hash.update(block)
+        return output_hash.hexdigest()
+
+def _manifest_path(output_dir):
+    return os.path.join(output_dir, _MANIFEST_FILENAME)
+
+def _pack_path(output_dir):
+    return os.path.join(output_dir, _PACK_FILENAME)
+
+class _PackedOutput(object):
+    """Output of one stream of a command, as a record in a result pack."""
+
+    __slots__ = ('path', 'offset', 'length', 'compression', 'size',
+                 'line_count', 'known_digest')
+
+    def __init__(self, path, offset, length, compression, size, line_count,
+                 digest=None):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.compression = compression
+        self.size = size
+        self.line_count = line_count
+        self.known_digest = digest
+
+    def _blocks(self):
+        decompressor = None
+        if self.compression == 'zlib':
+            import zlib
+            decompressor = zlib.decompressobj()
+        with open(self.path, 'rb') as pack_file:
+            pack_file.seek(self.offset)
+            unread = self.length
+            while unread > 0:
+                block = pack_file.read(min(_READ_SIZE, unread))
+                if not block:
+                    break
+                unread -= len(block)
+                if decompressor is not None:
+                    block = decompressor.decompress(block)
+                yield block
+        if decompressor is not None:
+            yield decompressor.flush()
+
+    def data(self):
+        return b''.join(self._blocks())
+
+    def text(self):
+        return self.data().decode('utf-8', 'replace')
+
+    def read(self):
+        """Contents and number of lines, which are known from the index."""
+        return self.text(), self.line_count
+
+    def tail(self, num_lines):
+        """Last ``num_lines`` lines and the number of lines of the output."""
+        if self.compression is None:
+            return _read_tail(self.path, num_lines, self.line_count,
+                              self.offset, self.offset + self.length)
+        data = self.data()
+        tail = data[_tail_start(data, num_lines):]
+        return tail.decode('utf-8', 'replace'), self.line_count
+
+    def first_line(self):
+        blocks = []
+        for block in self._blocks():
+            blocks.append(block)
+            if b'\n' in block:
+                break
+        first_line, newline, _ = b''.join(blocks).partition(b'\n')
+        return (first_line + newline).decode('utf-8', 'replace')
+
+    def iter_lines(self):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        pending = ''
+        for block in self._blocks():
+            lines = (pending + decoder.decode(block)).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        pending += decoder.decode(b'', True)
+        if pending:
+            yield pending
+
+    def digest(self):
+        if self.known_digest is not None:
+            return self.known_digest
+        import hashlib
+        output_hash = hashlib.sha1()
+        for block in self._blocks():
+            output_hash.update(block)
+        return output_hash.hexdigest()
+
+class _ResultPack(object):
+    """Append-only file the outputs of kept results are packed into.
+
+    Outputs are appended one after the other, each one compressed on its
+    own with zlib if ``compress`` is set, so that any of them can be read
+    back from its offset and length as recorded in the manifest. It spares
+    creating a file per output, and removing them afterwards.
+    """
+
+    __slots__ = ('path', 'pack_file', 'compression')
+
+    def __init__(self, output_dir, compress=False):
+        self.path = _pack_path(output_dir)
+        self.pack_file = open(self.path, 'ab')
+        self.compression = 'zlib' if compress else None
+
+    def _add(self, output):
+        self.pack_file.seek(0, os.SEEK_END)
+        offset = self.pack_file.tell()
+        compressor = None
+        if self.compression == 'zlib':
+            import zlib
+            compressor = zlib.compressobj()
+        for block in output.blocks():
+            if compressor is not None:
+                block = compressor.compress(block)
+            self.pack_file.write(block)
+        if compressor is not None:
+            self.pack_file.write(compressor.flush())
+        length = self.pack_file.tell() - offset
+        output.discard()
+        return _PackedOutput(self.path, offset, length, self.compression,
+                             output.size, output.line_count, output.digest())
+
+    def pack(self, result):
+        """The result with its outputs moved into the pack."""
+        packed_result = result._replace(stdout=self._add(result.stdout),
+                                        stderr=self._add(result.stderr))
+        self.pack_file.flush()
+        return packed_result
+
+    def close(self):
+        self.pack_file.close()
+
+def _output_record(output):
+    if isinstance(output, _PackedOutput):
+        return {
+            'offset': output.offset,
+            'length': output.length,
+            'compression': output.compression,
+            'size': output.size,
+            'lines': output.line_count,
+        }
+    return {
+        'path': os.path.basename(output.path),
+        'size': output.size,
+        'lines': output.line_count,
+    }
+
+class _ResultManifest(object):
+    """Index of the results kept in an output directory.
+
+    A line of JSON is appended to it for every result as soon as it's
+    recorded, with where each of its outputs is kept and its size and line
+    count, its return value and the timing of its job. Results are found
+    through it instead of listing the directory, a later line for the same
+    server and command replaces an earlier one. Every run given its
+    ``commands`` first appends a line with their digest, for the results
+    after it to be told apart from those of other commands.
+    """
+
+    __slots__ = ('manifest_file',)
+
+    def __init__(self, output_dir, commands=None):
+        self.manifest_file = open(_manifest_path(output_dir), 'a')
+        if commands is not None:
+            self._write({'commands': _commands_digest(commands)})
+
+    def _write(self, record):
+        import json
+        self.manifest_file.write(json.dumps(record, sort_keys=True,
+                                            separators=(',', ':',)))
+        self.manifest_file.write('\n')
+        self.manifest_file.flush()
+
+    def add(self, result, timing):
+        record = {
+            'server': result.server,
+            'cmd_num': result.cmd_num,
+            'retval': result.retval,
+            'attempts': result.attempts,
+            'started': timing.spawned,
+            'first_output': timing.first_output,
+            'exited': timing.exited,
+            'finished': timing.reaped,
+            'stdout': _output_record(result.stdout),
+            'stderr': _output_record(result.stderr),
+        }
+        self._write(record)
+
+    def close(self):
+        self.manifest_file.close()
+
+def _file_output(output_dir, output_record):
+    if 'offset' in output_record:
+        return _PackedOutput(_pack_path(output_dir), output_record['offset'],
+                             output_record['length'],
+                             output_record['compression'],
+                             output_record['size'], output_record['lines'])
+    return _FileOutput(os.path.join(output_dir, output_record['path']),
+                       output_record['size'], output_record['lines'])
+
+def _commands_digest(commands):
+    """Digest of every command of ``commands``, in the order they're run."""
+    import hashlib
+    import json
+    cmds = list(itertools.chain(*commands.values()))
+    return hashlib.sha1(json.dumps(cmds).encode('utf-8')).hexdigest()
+
+def _manifest_records(output_dir):
+    import json
+    with io.open(_manifest_path(output_dir), 'r',
+                 encoding='utf-8') as manifest_file:
+        for line in manifest_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # The last line is left incomplete if poh was interrupted
+                LOG.debug("Ignoring malformed manifest line %r", line)
+
+def _manifest_commands(output_dir):
+    """Digest of the commands last run into an output directory, if known.
+
+    Output directories kept before manifests recorded their commands, or
+    before there were manifests at all, don't say.
+    """
+    if not os.path.exists(_manifest_path(output_dir)):
+        return None
+    commands_digest = None
+    for record in _manifest_records(output_dir):
+        if 'commands' in record:
+            commands_digest = record['commands']
+    return commands_digest
+
+def _read_manifest(output_dir):
+    """Results in the manifest of an output directory, by server and cmd."""
+    results = collections.OrderedDict()
+    for record in _manifest_records(output_dir):
+        if 'server' not in record:
+            # The digest of the commands of a run
+            continue
+        server, cmd_num = record['server'], record['cmd_num']
+        results[(server, cmd_num,)] = _CmdResult(
+            server, cmd_num, record['retval'],
+            _file_output(output_dir, record['stdout']),
+            _file_output(output_dir, record['stderr']),
+            record.get('attempts', 1),
+        )
+    return results
+
+def _resumable_with(output_dir, commands):
+    """Whether the results in an output directory are of ``commands``."""
+    commands_digest = _manifest_commands(output_dir)
+    return commands_digest in (None, _commands_digest(commands))
 
+def _results_from_retval_files(output_dir):
     import glob
-    reader_funcs = {'retval': _read_int_from_file,
-                    'stdout': _read_entire_file,
-                    'stderr': _read_entire_file,}
+    retval_paths = sorted(glob.glob(os.path.join(output_dir, '*.*.retval')))
+    results = []
+    for rvpath in retval_paths:
+        server, cmdnum_str, _ = os.path.basename(rvpath).rsplit('.', 2)
+        try:
+            cmd_num = int(cmdnum_str)
+        except ValueError:
+            continue
+        results.append(_CmdResult(
+            server, cmd_num, _read_retval_from_file(rvpath),
+            _FileOutput(_result_path(output_dir, server, cmd_num, 'stdout')),
+            _FileOutput(_result_path(output_dir, server, cmd_num, 'stderr')),
+            1,
+        ))
+    return results
+
+def _results_from_dir(output_dir):
+    if os.path.exists(_manifest_path(output_dir)):
+        results = list(_read_manifest(output_dir).values())
+    else:
+        # Output directories kept before there were manifests only have
+        # their result files to go by
+        LOG.debug("No manifest in %r, looking for result files instead",
+                  output_dir)
+        results = _results_from_retval_files(output_dir)
+    LOG.debug("Found results of %d commands in %r", len(results),
+              output_dir)
+    return results
+
+def _kept_results(output_dir):
+    """Results kept in an output directory, by server and command number.
+
+    A directory kept before there were manifests is given one listing its
+    results, so that results added to it later don't hide them.
+    """
+    had_manifest = os.path.exists(_manifest_path(output_dir))
+    results = collections.OrderedDict(
+        ((result.server, result.cmd_num,), result)
+        for result in _results_from_dir(output_dir)
+    )
+    if not had_manifest and results:
+        manifest = _ResultManifest(output_dir)
+        for result in results.values():
+            manifest.add(result, _JobTiming(None, None, None, None))
+        manifest.close()
+    return results
 
+def _pending_jobs(kept_results, servers, num_cmds):
+    """Command numbers to run again on each server, by server.
+
+    Those are the commands that failed, or that have no result at all.
+    Servers with nothing to run again are left out.
+    """
+    pending = collections.OrderedDict()
+    for server in servers:
+        cmd_nums = set()
+        for cmd_num in range(1, num_cmds + 1):
+            result = kept_results.get((server, cmd_num,))
+            if result is None or result.retval != 0:
+                cmd_nums.add(cmd_num)
+        if cmd_nums:
+            pending[server] = cmd_nums
+    return pending
+
+def _cmd_output(result, filetype, one_line=False, tail_lines=None):
+    """Contents and line count of one of a command's result types.
+
+    Each output is read in a single pass. With ``one_line`` only the first
+    line of it is read, and its line count is left as None. With
+    ``tail_lines`` only that many lines at the end of it are read.
+    """
+    if filetype == 'retval':
+        return (result.retval, 1,)
+    if filetype == 'attempts':
+        return (result.attempts, 1,)
+    output = getattr(result, filetype)
     if one_line:
-        reader_func = _read_one_line
-
-        reader_funcs['stdout'] = reader_func
-        reader_funcs['stderr'] = reader_func
-
-    restypes = reader_funcs.keys()
-    globs = {filetype:'*.?.{}'.format(filetype) for filetype in restypes}
-    filepaths = {filetype: sorted(glob.glob(os.path.join(output_dir, pat)))
-                 for filetype, pat in globs.items()}
-    counts = {filetype: len(filelist)
-              for filetype, filelist in filepaths.items()}
-
-    LOG.debug("Found %d temp files in %r (%s)",
-              sum(counts.values()), output_dir,
-              ', '.join(['{}: {}'.format(key, value)
-                         for key, value in counts.items()]))
-
-    for filetype, filelist in filepaths.items():
-        LOG.debug("Reading files of type %r", filetype)
-        reader_func = reader_funcs.get(filetype)
-        for resultfile in filelist:
-            server, cmdnum_str, _ = os.path.basename(resultfile).rsplit('.', 2)
-            cmdnum = int(cmdnum_str)
-
-            server_results = results.setdefault(server, {})
-            cmd_results = server_results.setdefault(cmdnum, {
-                rt:None for rt in restypes
-            })
-
-            lines_in_file = _count_lines(resultfile)
-            LOG.debug("%r: %r", filetype, resultfile)
-            if filetype == 'stderr':
-                contents_string = reader_func(resultfile)
-                contents_string = re.sub(
-                    r'^ControlSocket .*?\n?$', '', contents_string
-                )
-                cmd_results[filetype] = (
-                    contents_string,
-                    lines_in_file,
-                )
-            else:
-                cmd_results[filetype] = (
-                    reader_func(resultfile),
-                    lines_in_file,
-                )
+        contents_string, line_count = output.first_line(), None
+    elif tail_lines:
+        contents_string, line_count = output.tail(tail_lines)
+    else:
+        contents_string, line_count = output.read()
+    if filetype == 'stderr':
+        contents_string = re.sub(
+            r'^ControlSocket .*?\n?$', '', contents_string
+        )
+    return (contents_string, line_count,)
+
+_RESULT_TYPES = ('retval', 'stdout', 'stderr', 'attempts',)
+
+def _cmd_outputs(result, one_line=False, tail_lines=None):
+    """Contents and line counts of a command's result, by result type."""
+    return {filetype: _cmd_output(result, filetype, one_line, tail_lines)
+            for filetype in _RESULT_TYPES}
+
+class _ResultOutputs(_Mapping):
+    """A command's outputs by result type, read whenever looked up.
+
+    Stands in for what _cmd_outputs returns where outputs are only needed
+    one command at a time, so that none are kept around once used. It's a
+    read-only mapping of the same result types.
+    """
+
+    __slots__ = ('result', 'one_line', 'tail_lines')
+
+    def __init__(self, result, one_line=False, tail_lines=None):
+        self.result = result
+        self.one_line = one_line
+        self.tail_lines = tail_lines
+
+    def __getitem__(self, filetype):
+        if filetype not in _RESULT_TYPES:
+            raise KeyError(filetype)
+        return _cmd_output(self.result, filetype, self.one_line,
+                           self.tail_lines)
+
+    def __iter__(self):
+        return iter(_RESULT_TYPES)
+
+    def __len__(self):
+        return len(_RESULT_TYPES)
+
+def _known_measure(output, measure):
+    """The size or line count of an output, or -1 if it has to be read."""
+    if hasattr(output, 'known_' + measure):
+        known = getattr(output, 'known_' + measure)
+        return -1 if known is None else known
+    return getattr(output, measure)
+
+class _ResultTable(object):
+    """Results of commands, kept a column at a time.
+
+    Rather than objects for every command, each result is a row in arrays
+    of server numbers, command numbers, return values, attempts, and sizes
+    and line counts of the outputs. Server names are stored once and rows
+    refer to them by number. Sizes and line counts that can't be known
+    without reading the outputs are left as -1 until they're asked for.
+
+    Outputs are only kept as handles to read them through if they have to.
+    Those in a result pack are kept as their offset and length in it, and
+    those in result files are found by the server and command, handles to
+    them are made up as they're looked up.
+
+    Views of the results by server or by command are orders of the rows,
+    none of the results are copied to make them.
+    """
+
+    def __init__(self, results=()):
+        self.servers = []
+        self.server_nums = {}
+        self.server_ids = array.array('i')
+        self.cmd_nums = array.array('i')
+        self.retvals = array.array('i')
+        # Statuses of commands that didn't get a return value, by row
+        self.statuses = {}
+        self.attempts = array.array('i')
+        self.sizes = {}
+        self.line_counts = {}
+        self.offsets = {}
+        self.lengths = {}
+        # Handles of the outputs, None for those that are made up
+        self.outputs = {}
+        for stream in ['stdout', 'stderr']:
+            self.sizes[stream] = array.array('l')
+            self.line_counts[stream] = array.array('l')
+            self.offsets[stream] = array.array('l')
+            self.lengths[stream] = array.array('l')
+            self.outputs[stream] = []
+        # Path and compression of the pack outputs are kept by offset in
+        self.pack = None
+        # Directory of the result files outputs are kept by server and cmd
+        self.output_dir = None
+        self.orders = {}
+        for result in results:
+            self.add(result)
+
+    def __len__(self):
+        return len(self.cmd_nums)
+
+    def add(self, result):
+        server_id = self.server_nums.get(result.server)
+        if server_id is None:
+            server_id = len(self.servers)
+            self.server_nums[result.server] = server_id
+            self.servers.append(result.server)
+        if result.retval in _STATUSES:
+            self.statuses[len(self)] = result.retval
+            self.retvals.append(-1)
+        else:
+            self.retvals.append(result.retval)
+        self.server_ids.append(server_id)
+        self.cmd_nums.append(result.cmd_num)
+        self.attempts.append(result.attempts)
+        for stream, output in [('stdout', result.stdout),
+                               ('stderr', result.stderr)]:
+            self._add_output(result, stream, output)
+        self.orders.clear()
+
+    def _add_output(self, result, stream, output):
+        self.sizes[stream].append(_known_measure(output, 'size'))
+        self.line_counts[stream].append(_known_measure(output, 'line_count'))
+        offset = length = -1
+        if isinstance(output, _PackedOutput) and \
+           self.pack in (None, (output.path, output.compression,)):
+            self.pack = (output.path, output.compression,)
+            offset, length = output.offset, output.length
+            output = None
+        elif isinstance(output, _FileOutput):
+            output_dir = os.path.dirname(output.path)
+            if self.output_dir in (None, output_dir) and \
+               output.path == _result_path(output_dir, result.server,
+                                           result.cmd_num, stream):
+                self.output_dir = output_dir
+                output = None
+        self.offsets[stream].append(offset)
+        self.lengths[stream].append(length)
+        self.outputs[stream].append(output)
+
+    def server(self, row):
+        return self.servers[self.server_ids[row]]
+
+    def retval(self, row):
+        return self.statuses.get(row, self.retvals[row])
+
+    def output(self, row, stream):
+        """Handle to read an output through, made up if it isn't kept."""
+        output = self.outputs[stream][row]
+        if output is not None:
+            return output
+        size = self.sizes[stream][row]
+        line_count = self.line_counts[stream][row]
+        offset = self.offsets[stream][row]
+        if offset >= 0:
+            pack_path, compression = self.pack
+            return _PackedOutput(pack_path, offset, self.lengths[stream][row],
+                                 compression, size, line_count)
+        return _FileOutput(
+            _result_path(self.output_dir, self.server(row),
+                         self.cmd_nums[row], stream),
+            None if size < 0 else size,
+            None if line_count < 0 else line_count,
+        )
 
-            total_lines += lines_in_file
+    def _measure(self, columns, measure, row, stream):
+        column = columns[stream]
+        if column[row] < 0:
+            column[row] = getattr(self.output(row, stream), measure)
+        return column[row]
+
+    def size(self, row, stream):
+        return self._measure(self.sizes, 'size', row, stream)
+
+    def line_count(self, row, stream):
+        return self._measure(self.line_counts, 'line_count', row, stream)
+
+    def result(self, row):
+        """The result in ``row``, made up as it's looked up."""
+        return _CmdResult(self.server(row), self.cmd_nums[row],
+                          self.retval(row), self.output(row, 'stdout'),
+                          self.output(row, 'stderr'), self.attempts[row])
+
+    def rows(self, transposed=False):
+        """Row numbers sorted by server and then command number.
+
+        With ``transposed`` they're sorted by command number first. Each
+        order is only worked out again once more results are added.
+        """
+        order = self.orders.get(transposed)
+        if order is None:
+            # Sorted by a number made of the rank of the server's name and
+            # the command number, rather than by a tuple for every row
+            server_ranks = array.array('l', [0] * len(self.servers))
+            sorted_ids = sorted(range(len(self.servers)),
+                                key=self.servers.__getitem__)
+            for rank, server_id in enumerate(sorted_ids):
+                server_ranks[server_id] = rank
+            server_ids, cmd_nums = self.server_ids, self.cmd_nums
+            if transposed:
+                num_servers = len(self.servers)
+                sortkey = lambda row: (cmd_nums[row] * num_servers +
+                                       server_ranks[server_ids[row]])
+            else:
+                num_cmds = max(cmd_nums or [0]) + 1
+                sortkey = lambda row: (server_ranks[server_ids[row]] *
+                                       num_cmds + cmd_nums[row])
+            order = array.array('l', sorted(range(len(self)), key=sortkey))
+            self.orders[transposed] = order
+        return order
+
+    def by_server(self, one_line=False, tail_lines=None):
+        """Outputs by server and command number, as read_result_files."""
+        return _TableView(self, False, one_line, tail_lines)
+
+    def by_command(self, one_line=False, tail_lines=None):
+        """Outputs by command number and server."""
+        return _TableView(self, True, one_line, tail_lines)
+
+class _TableView(_Mapping):
+    """Outputs of the results in a _ResultTable, read whenever looked up.
+
+    Results are by server and then command number, or by command number
+    and then server if ``transposed``. Each key is a span of the rows in
+    that order. The span last looked up is held on to, so that looking up
+    results one after another in it doesn't index it again every time.
+    """
+
+    def __init__(self, table, transposed=False, one_line=False,
+                 tail_lines=None):
+        self.table = table
+        self.transposed = transposed
+        self.one_line = one_line
+        self.tail_lines = tail_lines
+        self.order = table.rows(transposed)
+        self.spans = collections.OrderedDict()
+        self.last_span = None
+        for position, row in enumerate(self.order):
+            key = self.major_key(row)
+            start, _ = self.spans.get(key, (position, None,))
+            self.spans[key] = (start, position + 1,)
+
+    def major_key(self, row):
+        if self.transposed:
+            return self.table.cmd_nums[row]
+        return self.table.server(row)
+
+    def minor_key(self, row):
+        if self.transposed:
+            return self.table.server(row)
+        return self.table.cmd_nums[row]
+
+    def outputs(self, row):
+        return _ResultOutputs(self.table.result(row), self.one_line,
+                              self.tail_lines)
+
+    def __getitem__(self, key):
+        if self.last_span is None or self.last_span.key != key:
+            start, end = self.spans[key]
+            self.last_span = _TableSpan(self, key, start, end)
+        return self.last_span
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def transpose(self):
+        return _TableView(self.table, not self.transposed, self.one_line,
+                          self.tail_lines)
+
+class _TableSpan(_Mapping):
+    """The results of one server, or of one command, in a _TableView.
+
+    Results are looked up through the positions of their keys from the
+    start of the span, only worked out once something is looked up.
+    """
+
+    def __init__(self, view, key, start, end):
+        self.view = view
+        self.key = key
+        self.start = start
+        self.end = end
+        self.positions = None
+
+    def _rows(self):
+        order = self.view.order
+        for position in range(self.start, self.end):
+            yield order[position]
+
+    def __getitem__(self, key):
+        if self.positions is None:
+            self.positions = dict((self.view.minor_key(row), offset,)
+                                  for offset, row in enumerate(self._rows()))
+        offset = self.positions[key]
+        return self.view.outputs(self.view.order[self.start + offset])
+
+    def __iter__(self):
+        for row in self._rows():
+            yield self.view.minor_key(row)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def items(self):
+        return [(self.view.minor_key(row), self.view.outputs(row),)
+                for row in self._rows()]
+
+def read_result_files(output_dir, one_line=False, tail_lines=None):
+    """Read results in ``output_dir`` by server and command number.
+
+    Results are a read-only mapping of servers to mappings of command
+    numbers to their outputs, which are read as they're looked up. With
+    ``tail_lines`` only that many lines are read from the end of each
+    output, line counts are still those of the whole output.
+    """
+    return _ResultTable(_results_from_dir(output_dir)).by_server(one_line,
+                                                                 tail_lines)
+
+_ResultGroup = collections.namedtuple('_ResultGroup', ['result', 'servers'])
+
+def _group_sortkey(group):
+    # Biggest groups first, the rest in the order of their first server
+    return (-len(group.servers), min(group.servers))
+
+def _result_identity(result):
+    """Return value and digests of the outputs of a command's result."""
+    stderr_digest = result.stderr.digest()
+    if result.stderr.line_count == 1 and \
+       _is_control_socket_noise(result.stderr.first_line()):
+        # The warning names the control socket of the server, it would set
+        # results apart that are otherwise the same
+        stderr_digest = None
+    return (result.retval, result.stdout.digest(), stderr_digest,)
+
+class _ResultGroups(object):
+    """Results of every command grouped by what they are, as jobs finish.
+
+    Results of a command with the same return value, stdout and stderr make
+    up a group, told apart by the digests of their outputs as worked out
+    while capturing them. Only the result of the first server of a group is
+    kept to stand for all of them, the outputs of the others are discarded
+    as they're grouped unless ``keep_output`` is set. Outputs held on to
+    grow with the number of distinct results rather than of servers.
+    """
+
+    def __init__(self, keep_output=False):
+        self.keep_output = keep_output
+        self.groups = {}
+
+    def add(self, result):
+        cmd_groups = self.groups.setdefault(result.cmd_num, {})
+        identity = _result_identity(result)
+        group = cmd_groups.get(identity)
+        if group is None:
+            cmd_groups[identity] = _ResultGroup(result, [result.server])
+            return
+        group.servers.append(result.server)
+        if not self.keep_output:
+            result.stdout.discard()
+            result.stderr.discard()
+
+    def on_finish(self, job):
+        for result in job.results:
+            self.add(result)
+
+    def command_groups(self):
+        """Groups of every command by command number, biggest first."""
+        return {cmd_num: sorted(cmd_groups.values(), key=_group_sortkey)
+                for cmd_num, cmd_groups in self.groups.items()}
+
+    def server_groups(self):
+        """Servers that got the same results for all commands, together.
+
+        Each group has the results standing for its servers by command
+        number in place of a single result.
+        """
+        numbered_results = []
+        group_nums_of = collections.defaultdict(list)
+        for cmd_num, cmd_groups in sorted(self.groups.items()):
+            for group in cmd_groups.values():
+                for server in group.servers:
+                    group_nums_of[server].append(len(numbered_results))
+                numbered_results.append((cmd_num, group.result,))
+
+        servers_of = collections.defaultdict(list)
+        for server, group_nums in group_nums_of.items():
+            servers_of[tuple(group_nums)].append(server)
+        server_groups = [
+            _ResultGroup(dict(numbered_results[group_num]
+                              for group_num in group_nums), servers)
+            for group_nums, servers in servers_of.items()
+        ]
+        return sorted(server_groups, key=_group_sortkey)
+
+def _number_ranges(numbers):
+    """Runs of consecutive numbers, as (first, last) pairs."""
+    ranges = []
+    for number in sorted(numbers):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ranges
+
+def _compact_servers(servers):
+    """Servers listed in short, with runs of numbered names as ranges.
+
+    Names that only differ in the number they end with are folded together,
+    e.g. web01, web02, web03 and web07 into web[01-03,07]. Numbers padded
+    with zeros are only folded with those of the same width.
+    """
+    numbered = collections.OrderedDict()
+    for server in sorted(servers):
+        match = re.match(r'^(.*?)(\d+)(\D*)$', server)
+        if match is None:
+            numbered[(server, None,)] = None
+            continue
+        prefix, digits, suffix = match.groups()
+        numbered.setdefault((prefix, suffix,), []).append(digits)
 
-    LOG.debug("There were a total of %d lines in results files", total_lines)
+    pieces = []
+    for (prefix, suffix), digit_strings in numbered.items():
+        if digit_strings is None:
+            pieces.append(prefix)
+            continue
+        padded_widths = {len(digits) for digits in digit_strings
+                         if len(digits) > 1 and digits.startswith('0')}
+        numbers_by_width = collections.OrderedDict()
+        for digits in digit_strings:
+            width = len(digits) if len(digits) in padded_widths else 0
+            numbers_by_width.setdefault(width, []).append(int(digits))
+        for width, numbers in numbers_by_width.items():
+            ranges = [
+                str(first).zfill(width) if first == last else
+                '{}-{}'.format(str(first).zfill(width),
+                               str(last).zfill(width))
+                for first, last in _number_ranges(numbers)
+            ]
+            if len(numbers) == 1:
+                pieces.append('{}{}{}'.format(prefix, ranges[0], suffix))
+            else:
+                pieces.append('{}[{}]{}'.format(prefix, ','.join(ranges),
+                                                suffix))
+    return ', '.join(pieces)
 
-    return results
+def _servers_summary(servers):
+    return '{} server{}: {}'.format(len(servers),
+                                    '' if len(servers) == 1 else 's',
+                                    _compact_servers(servers))
 
 def _time_strings(timestamp):
+    import datetime
     local_time = datetime.datetime.fromtimestamp(timestamp)
     local_string = local_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:23]
 
@@ -540,53 +1790,7 @@ def _time_strings(timestamp):
     utc_string = utc_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:23]
     return local_string, utc_string
 
-def _std_streams_lines(cmd_results, long_output=False, limit_lines=25):
-    output_lines = []
-
-    stdout, stdout_ln = cmd_results['stdout']
-    stderr, stderr_ln = cmd_results['stderr']
-
-    if not long_output:
-        lnum = 1
-        stderr_lines = []
-        for lnum, line in enumerate(stderr.splitlines(), 1):
-            stderr_lines.append('      X '+line)
-        if lnum > limit_lines:
-            output_lines.append('      X ...')
-            output_lines.extend(stderr_lines[-limit_lines:])
-            output_lines.append(
-                '      X Output clipped to the last {} of {} lines'.format(
-                    limit_lines, lnum
-                ),
-            )
-        else:
-            output_lines.extend(stderr_lines)
-
-        stdout_lines = []
-        for lnum, line in enumerate(stdout.splitlines(), 1):
-            stdout_lines.append('      > '+line)
-        if lnum > limit_lines:
-            output_lines.append('      > ...')
-            output_lines.extend(stdout_lines[-limit_lines:])
-            output_lines.append(
-                '      > Output clipped to the last {} of {} lines'.format(
-                    limit_lines, lnum
-                ),
-            )
-        else:
-            output_lines.extend(stdout_lines)
-
-    else:
-        output_lines.extend(['      X '+line for line in stderr.splitlines()])
-        output_lines.extend(['      > '+line for line in stdout.splitlines()])
-    if stdout_ln + stderr_ln > 0:
-        output_lines.append('')
-    return output_lines
-
-def print_execution_results(outputs, commands, one_line=False,
-                            long_output=False, wide_output=False,
-                            transpose_output=False, color=False,
-                            times=(None, None,)):
+def _time_header_lines(times, color=False):
     output_lines = []
     start_time, end_time = times
 
@@ -607,32 +1811,18 @@ def print_execution_results(outputs, commands, one_line=False,
             elapsed=end_time - start_time,
         ).splitlines())
         output_lines.append('')
+    return output_lines
 
-    term_columns, term_lines = _get_terminal_size(sys.stdout.fileno())
-    if term_columns is None:
-        wide_output = True
-    if term_lines is None:
-        long_output = True
-
-    LOG.debug("Terminal dimensions = width: %d, height: %d",
-              term_columns, term_lines)
-
-    cmd_map = []
-    for cmdfile, cmdlist in commands.items():
-        cmd_map.extend([
-            ((cmdfile, cmd_num,), cmd) for cmd_num, cmd in enumerate(cmdlist)
-        ])
-    cmd_map = {cmd_idx:(gcmd_num, cmd,)
-               for gcmd_num, (cmd_idx, cmd,) in enumerate(cmd_map, 1)}
-
-    if cmd_map:
+def _commands_lines(numbered_cmds, color=False):
+    output_lines = []
+    if numbered_cmds:
         if color:
             output_lines.append(_escaped_with("Commands run:", ['fg_white']))
         else:
             output_lines.append("Commands run:")
         output_lines.extend([
             "  {:4d}. {}".format(gcmd_num, _printable_string(cmd))
-            for gcmd_num, cmd in sorted(cmd_map.values())
+            for gcmd_num, cmd in numbered_cmds
         ])
         output_lines.append('')
 
@@ -640,212 +1830,2082 @@ def print_execution_results(outputs, commands, one_line=False,
         output_lines.append(_escaped_with("Results:", ['fg_white']))
     else:
         output_lines.append("Results:")
-    if one_line:
-        _format_retval = lambda x: '{:^5s}'.format('[{}]'.format(x))
-        if color:
-            def _format_retval(retval):
-                if retval == 0:
-                    fmts = ['fg_green']
-                else:
-                    fmts = ['fg_red']
-                bracketed = '[{}]'.format(retval)
-                formatted_string = '{:^5}'.format(bracketed)
-                colorized_string = _escaped_with(formatted_string, pre=fmts)
-                return colorized_string
-
-        LOG.debug("Output set to one-line, ignoring transpose_output setting.")
-        line_proto_format = textwrap.dedent("""\
-        {{server_name:>{server_width}s}}:  {{retval_block}}  {{output_line}}
-        """)
-        output_cells = []
-        for server, results in outputs.items():
-            cells = [server]
-            cells.append([_format_retval(results[cmd]['retval'][0])
-                          for cmd in sorted(results.keys())])
-            cells.append(results[1]['stdout'][0].split('\n', 1)[0])
-            output_cells.append(cells)
-        widest_server = max([len(server) for server in outputs.keys()])
-        line_format = line_proto_format.rstrip('\n').format(
-            server_width=widest_server+4
-        )
+    return output_lines
 
-        output_lines.extend([
-            line_format.format(server_name=svname,
-                               retval_block=''.join(retvals),
-                               output_line=output_line.rstrip('\n'))
-            for svname, retvals, output_line in sorted(output_cells)
-        ])
-    else:
-        def _format_retval(retval, color):
-            formatted_string = '[RETVAL={}]'.format(retval)
-            if color:
-                if retval == 0:
-                    formatted_string = _escaped_with(formatted_string,
-                                                     ['fg_green'])
-                else:
-                    formatted_string = _escaped_with(formatted_string,
-                                                     ['fg_red'])
-            return formatted_string
-        if transpose_output:
-            outputs_by_num = {}
-            for srv, srvres in outputs.items():
-                for cmd_num, cmdres in srvres.items():
-                    gcmdres = outputs_by_num.setdefault(cmd_num, {})
-                    gcmdres[srv] = cmdres
-
-            for gcmd_num, cmd in sorted(cmd_map.values()):
+def _line_shortener(term_columns, color=False):
+    if not color:
+        return lambda line: line[:term_columns-3]+'...'
+
+    def _shortened(line):
+        escaped_chars_num = sum(map(len, re.findall('\x1b\[.*?m', line)))
+        if term_columns+escaped_chars_num >= len(line):
+            return line
+        return line[:term_columns+escaped_chars_num-3]+'...'
+    return _shortened
+
+def _formatted_retval(retval, color):
+    formatted_string = '[RETVAL={}]'.format(retval)
+    if color:
+        formatted_string = _escaped_with(formatted_string,
+                                         [_retval_color(retval)])
+    return formatted_string
+
+def _retval_color(retval):
+    if retval == 0:
+        return 'fg_green'
+    if retval in _STATUSES:
+        return 'fg_yellow'
+    return 'fg_red'
+
+def _std_streams_lines(cmd_results, long_output=False, limit_lines=25):
+    output_lines = []
+
+    stdout, stdout_ln = cmd_results['stdout']
+    stderr, stderr_ln = cmd_results['stderr']
+
+    if not long_output:
+        # Line counts are those of the whole output, which may have been
+        # read only as far back as needed to show its last lines
+        for prefix, contents, line_count in [('      X ', stderr, stderr_ln),
+                                             ('      > ', stdout, stdout_ln)]:
+            last_lines = [prefix+line
+                          for line in contents.splitlines()[-limit_lines:]]
+            if line_count > limit_lines:
+                output_lines.append(prefix+'...')
+                output_lines.extend(last_lines)
                 output_lines.append(
-                    "  cmd#{:<4d}$ {}".format(gcmd_num, _printable_string(cmd))
+                    prefix+'Output clipped to the last {} of {} lines'.format(
+                        limit_lines, line_count
+                    ),
                 )
-                cmdres = outputs_by_num.get(gcmd_num, [])
-                for srv_num, (srv, srvres) in enumerate(sorted(cmdres.items()), 1):
-                    retval = srvres['retval'][0]
-                    stdout_ln = srvres['stdout'][1]
-                    stderr_ln = srvres['stderr'][1]
-                    output_lines.append(
-                        "      srv#{:<4d} {:12s} (l#:{}/{}) - {}".format(
-                            srv_num,
-                            _format_retval(retval, color),
-                            stderr_ln,
-                            stdout_ln,
-                            srv
-                        )
-                    )
-                    output_lines.extend(
-                        _std_streams_lines(srvres,
-                                           long_output=long_output,
-                                           limit_lines=term_lines)
-                    )
+            else:
+                output_lines.extend(last_lines)
+
+    else:
+        output_lines.extend(['      X '+line for line in stderr.splitlines()])
+        output_lines.extend(['      > '+line for line in stdout.splitlines()])
+    if stdout_ln + stderr_ln > 0:
+        output_lines.append('')
+    return output_lines
+
+def _shortened_lines(lines, term_columns, color=False):
+    """Shorten each of the lines that doesn't fit in the terminal."""
+    shortened = _line_shortener(term_columns, color)
+    for line in lines:
+        yield shortened(line) if len(line) > term_columns else line
+
+def _write_lines(lines, stream=None):
+    """Write lines to stream as they come, a buffer's worth at a time."""
+    stream = stream or sys.stdout
+    buffered, buffered_size = [], 0
+    for line in lines:
+        buffered.append(line)
+        buffered_size += len(line) + 1
+        if buffered_size >= _WRITE_BUFFER_SIZE:
+            buffered.append('')
+            stream.write('\n'.join(buffered))
+            buffered, buffered_size = [], 0
+    if buffered:
+        buffered.append('')
+        stream.write('\n'.join(buffered))
+    stream.flush()
+
+def _fetched_outputs(cmdres):
+    """Look a command's outputs up once, to format them from then on."""
+    fetched = {filetype: cmdres[filetype]
+               for filetype in ('retval', 'stdout', 'stderr')}
+    try:
+        fetched['attempts'] = cmdres['attempts']
+    except KeyError:
+        # Outputs put together before there were retries
+        pass
+    return fetched
+
+def _attempts_note(cmd_results):
+    attempts = cmd_results.get('attempts', (1,))[0]
+    if attempts > 1:
+        return ' (attempts:{})'.format(attempts)
+    return ''
+
+def _command_map(commands):
+    cmd_map = []
+    for cmdfile, cmdlist in commands.items():
+        cmd_map.extend([
+            ((cmdfile, cmd_num,), cmd) for cmd_num, cmd in enumerate(cmdlist)
+        ])
+    return {cmd_idx:(gcmd_num, cmd,)
+            for gcmd_num, (cmd_idx, cmd,) in enumerate(cmd_map, 1)}
+
+def _one_line_report_lines(outputs, color=False):
+    _format_retval = lambda x: '{:^5s}'.format('[{}]'.format(
+        _STATUS_ABBREVIATIONS.get(x, x)
+    ))
+    if color:
+        def _format_retval(retval):
+            fmts = [_retval_color(retval)]
+            bracketed = '[{}]'.format(
+                _STATUS_ABBREVIATIONS.get(retval, retval)
+            )
+            formatted_string = '{:^5}'.format(bracketed)
+            colorized_string = _escaped_with(formatted_string, pre=fmts)
+            return colorized_string
+
+    LOG.debug("Output set to one-line, ignoring transpose_output setting.")
+    line_proto_format = (
+        '{{server_name:>{server_width}s}}:  {{retval_block}}  {{output_line}}'
+    )
+    widest_server = max([len(server) for server in outputs.keys()])
+    line_format = line_proto_format.format(
+        server_width=widest_server+4
+    )
+    for server, results in sorted(outputs.items()):
+        retvals = [_format_retval(results[cmd]['retval'][0])
+                   for cmd in sorted(results.keys())]
+        output_line = results[1]['stdout'][0].split('\n', 1)[0]
+        yield line_format.format(server_name=server,
+                                 retval_block=''.join(retvals),
+                                 output_line=output_line.rstrip('\n'))
+
+def _outputs_by_num(outputs):
+    """Outputs by command number and server, from outputs by server."""
+    if isinstance(outputs, _TableView):
+        return outputs.transpose()
+    outputs_by_num = {}
+    for srv, srvres in outputs.items():
+        for cmd_num, cmdres in srvres.items():
+            gcmdres = outputs_by_num.setdefault(cmd_num, {})
+            gcmdres[srv] = cmdres
+    return outputs_by_num
+
+def _transposed_report_lines(outputs, cmd_map, long_output=False,
+                             color=False, limit_lines=25):
+    outputs_by_num = _outputs_by_num(outputs)
+
+    for gcmd_num, cmd in sorted(cmd_map.values()):
+        yield "  cmd#{:<4d}$ {}".format(gcmd_num, _printable_string(cmd))
+        cmdres = outputs_by_num.get(gcmd_num, {})
+        for srv_num, (srv, srvres) in enumerate(sorted(cmdres.items()), 1):
+            srvres = _fetched_outputs(srvres)
+            yield "      srv#{:<4d} {:12s} (l#:{}/{}){} - {}".format(
+                srv_num,
+                _formatted_retval(srvres['retval'][0], color),
+                srvres['stderr'][1],
+                srvres['stdout'][1],
+                _attempts_note(srvres),
+                srv
+            )
+            for line in _std_streams_lines(srvres, long_output=long_output,
+                                           limit_lines=limit_lines):
+                yield line
+
+def _server_report_lines(outputs, cmd_map, long_output=False, color=False,
+                         limit_lines=25):
+    cmds_by_num = {gcmd_num:_printable_string(cmd)
+                   for gcmd_num, cmd in sorted(cmd_map.values())}
+    for srv_num, (srv, srvres) in enumerate(sorted(outputs.items()), 1):
+        yield "  srv#{:<4d}- {}".format(srv_num, srv)
+        for cmd_num, cmdres in sorted(srvres.items()):
+            cmdres = _fetched_outputs(cmdres)
+            yield "      cmd#{:<4d} {:12s} (l#:{}/{}){} $ {}".format(
+                cmd_num,
+                _formatted_retval(cmdres['retval'][0], color),
+                cmdres['stderr'][1],
+                cmdres['stdout'][1],
+                _attempts_note(cmdres),
+                cmds_by_num[cmd_num]
+            )
+            for line in _std_streams_lines(cmdres, long_output=long_output,
+                                           limit_lines=limit_lines):
+                yield line
+
+def _grouped_transposed_report_lines(groups, cmd_map, long_output=False,
+                                     color=False, limit_lines=25):
+    tail_lines = None if long_output else limit_lines
+    command_groups = groups.command_groups()
+    for gcmd_num, cmd in sorted(cmd_map.values()):
+        yield "  cmd#{:<4d}$ {}".format(gcmd_num, _printable_string(cmd))
+        for grp_num, group in enumerate(command_groups.get(gcmd_num, []), 1):
+            grpres = _fetched_outputs(_ResultOutputs(group.result,
+                                                     tail_lines=tail_lines))
+            yield "      grp#{:<4d} {:12s} (l#:{}/{}) - {}".format(
+                grp_num,
+                _formatted_retval(grpres['retval'][0], color),
+                grpres['stderr'][1],
+                grpres['stdout'][1],
+                _servers_summary(group.servers)
+            )
+            for line in _std_streams_lines(grpres, long_output=long_output,
+                                           limit_lines=limit_lines):
+                yield line
+
+def _grouped_server_report_lines(groups, cmd_map, long_output=False,
+                                 color=False, limit_lines=25):
+    tail_lines = None if long_output else limit_lines
+    cmds_by_num = {gcmd_num:_printable_string(cmd)
+                   for gcmd_num, cmd in sorted(cmd_map.values())}
+    for grp_num, group in enumerate(groups.server_groups(), 1):
+        yield "  grp#{:<4d}- {}".format(grp_num,
+                                        _servers_summary(group.servers))
+        for cmd_num, result in sorted(group.result.items()):
+            cmdres = _fetched_outputs(_ResultOutputs(result,
+                                                     tail_lines=tail_lines))
+            yield "      cmd#{:<4d} {:12s} (l#:{}/{}) $ {}".format(
+                cmd_num,
+                _formatted_retval(cmdres['retval'][0], color),
+                cmdres['stderr'][1],
+                cmdres['stdout'][1],
+                cmds_by_num[cmd_num]
+            )
+            for line in _std_streams_lines(cmdres, long_output=long_output,
+                                           limit_lines=limit_lines):
+                yield line
+
+def print_execution_results(outputs, commands, one_line=False,
+                            long_output=False, wide_output=False,
+                            transpose_output=False, color=False,
+                            times=(None, None,), grouped=False):
+    """Print the report of a run's results.
+
+    The report is formatted, shortened and written a line at a time, so
+    ``outputs`` may hold anything that looks commands' outputs up on demand
+    and only the lines being written are ever in memory.
+
+    With ``grouped``, ``outputs`` are _ResultGroups rather than outputs by
+    server, and every distinct result is printed once along with the
+    servers that got it. It doesn't go along with ``one_line``.
+    """
+    term_columns, term_lines = _get_terminal_size(sys.stdout.fileno())
+    if term_columns is None:
+        wide_output = True
+    if term_lines is None:
+        long_output = True
+
+    LOG.debug("Terminal dimensions = width: %d, height: %d",
+              term_columns, term_lines)
+
+    cmd_map = _command_map(commands)
+
+    header_lines = itertools.chain(
+        _time_header_lines(times, color),
+        _commands_lines(sorted(cmd_map.values()), color)
+    )
+    if grouped and transpose_output:
+        report_lines = _grouped_transposed_report_lines(
+            outputs, cmd_map, long_output, color, term_lines
+        )
+    elif grouped:
+        report_lines = _grouped_server_report_lines(outputs, cmd_map,
+                                                    long_output, color,
+                                                    term_lines)
+    elif one_line:
+        report_lines = _one_line_report_lines(outputs, color)
+    elif transpose_output:
+        report_lines = _transposed_report_lines(outputs, cmd_map, long_output,
+                                                color, term_lines)
+    else:
+        report_lines = _server_report_lines(outputs, cmd_map, long_output,
+                                            color, term_lines)
+
+    for output_lines in [header_lines, report_lines]:
+        if not wide_output:
+            output_lines = _shortened_lines(output_lines, term_columns, color)
+        _write_lines(output_lines)
+
+def _result_path(output_dir, server, cmd_num, filetype):
+    return os.path.join(output_dir, '.'.join([server, str(cmd_num), filetype]))
+
+def _write_retval_file(output_dir, server, cmd_num, retval):
+    filepath = _result_path(output_dir, server, cmd_num, 'retval')
+    with open(filepath, 'w') as retval_file:
+        retval_file.write('{}\n'.format(retval))
+
+class _CapturedOutput(object):
+    """Output of one stream of a command, captured in memory.
+
+    The output is kept in memory until it grows past ``_SPILL_THRESHOLD``
+    bytes, from then on it's written to ``path`` instead. With ``keep`` it
+    is written to ``path`` from the start, as is expected of a kept output
+    directory. Its size, number of lines and digest are worked out as it's
+    written, so that none of them needs another pass over it. The digest is
+    only held on to as a string once the output is closed. ``output_dir``
+    is whatever has to be kept around for ``path`` to stay there, if any.
+    """
+
+    __slots__ = ('path', 'buffer', 'spill_file', 'size', 'newlines',
+                 'last_byte', 'output_hash', 'known_digest', 'output_dir')
+
+    def __init__(self, path, keep=False):
+        self.path = path
+        self.buffer = bytearray()
+        self.spill_file = None
+        self.size = 0
+        self.newlines = 0
+        self.last_byte = b'\n'
+        # Most outputs are empty, hashes are only made for those that aren't
+        self.output_hash = None
+        self.known_digest = _EMPTY_DIGEST
+        self.output_dir = None
+        if keep:
+            self._spill()
+
+    @property
+    def on_disk(self):
+        return self.buffer is None
+
+    @property
+    def line_count(self):
+        # Same count as iterating over the lines of the file would give
+        if self.last_byte != b'\n':
+            return self.newlines + 1
+        return self.newlines
+
+    def _spill(self):
+        LOG.debug("Writing output to %r", self.path)
+        self.spill_file = open(self.path, 'wb')
+        self.spill_file.write(self.buffer)
+        self.buffer = None
+
+    def write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        self.newlines += data.count(b'\n')
+        self.last_byte = data[-1:]
+        if self.output_hash is None:
+            import hashlib
+            self.output_hash = hashlib.sha1()
+        self.output_hash.update(data)
+        if not self.on_disk and len(self.buffer) + len(data) > \
+           _SPILL_THRESHOLD:
+            self._spill()
+        if self.on_disk:
+            self.spill_file.write(data)
+        else:
+            self.buffer.extend(data)
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+        if self.output_hash is not None:
+            self.known_digest = self.output_hash.hexdigest()
+            self.output_hash = None
+
+    def discard(self):
+        """Close and let go of the output, removing it from disk if there."""
+        self.close()
+        if self.on_disk:
+            os.remove(self.path)
         else:
-            cmds_by_num = {gcmd_num:_printable_string(cmd)
-                           for gcmd_num, cmd in sorted(cmd_map.values())}
-            for srv_num, (srv, srvres) in enumerate(sorted(outputs.items()), 1):
-                output_lines.append("  srv#{:<4d}- {}".format(srv_num, srv))
-                for cmd_num, cmdres in sorted(srvres.items()):
-                    retval = cmdres['retval'][0]
-                    stdout_ln = cmdres['stdout'][1]
-                    stderr_ln = cmdres['stderr'][1]
-                    output_lines.append(
-                        "      cmd#{:<4d} {:12s} (l#:{}/{}) $ {}".format(
-                            cmd_num,
-                            _format_retval(retval, color),
-                            stderr_ln,
-                            stdout_ln,
-                            cmds_by_num[cmd_num]
-                        )
-                    )
-                    output_lines.extend(
-                        _std_streams_lines(cmdres,
-                                           long_output=long_output,
-                                           limit_lines=term_lines)
-                    )
-
-    if not wide_output:
-        if not color:
-            _shortened = lambda line: line[:term_columns-3]+'...'
+            self.buffer = bytearray()
+
+    def data(self):
+        if not self.on_disk:
+            return bytes(self.buffer)
+        with open(self.path, 'rb') as input_file:
+            return input_file.read()
+
+    def blocks(self):
+        """The output a block at a time, as it's only read once closed."""
+        if not self.on_disk:
+            yield bytes(self.buffer)
+            return
+        with open(self.path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(_READ_SIZE), b''):
+                yield block
+
+    def text(self):
+        return self.data().decode('utf-8', 'replace')
+
+    def read(self):
+        """Contents and number of lines, which are counted already."""
+        return self.text(), self.line_count
+
+    def tail(self, num_lines):
+        """Last ``num_lines`` lines and the number of lines of the output."""
+        if self.on_disk:
+            return _read_tail(self.path, num_lines, self.line_count)
+        data = bytes(self.buffer)
+        tail = data[_tail_start(data, num_lines):]
+        return tail.decode('utf-8', 'replace'), self.line_count
+
+    def first_line(self):
+        if not self.on_disk:
+            first_line = self.buffer.split(b'\n', 1)[0]
+            if len(first_line) < self.size:
+                first_line += b'\n'
+            return first_line.decode('utf-8', 'replace')
+        with open(self.path, 'rb') as input_file:
+            return input_file.readline().decode('utf-8', 'replace')
+
+    def iter_lines(self):
+        if not self.on_disk:
+            for line in self.text().splitlines(True):
+                yield line
+            return
+        with io.open(self.path, 'r', encoding='utf-8',
+                     errors='replace') as input_file:
+            for line in input_file:
+                yield line
+
+    def digest(self):
+        if self.output_hash is not None:
+            return self.output_hash.hexdigest()
+        return self.known_digest
+
+class _StreamCapture(object):
+    """One output stream of a job, read from its pipe as it arrives.
+
+    Everything read is written as is to ``output`` and handed back decoded,
+    keeping multi-byte characters split across reads whole.
+    """
+
+    __slots__ = ('name', 'pipe', 'output', 'decoder')
+
+    def __init__(self, name, pipe, output):
+        self.name = name
+        self.pipe = pipe
+        self.output = output
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def fileno(self):
+        return self.pipe.fileno()
+
+    @property
+    def closed(self):
+        return self.pipe.closed
+
+    def read(self):
+        """Read what's available in the pipe, None means end of file."""
+        data = os.read(self.pipe.fileno(), _READ_SIZE)
+        if not data:
+            return None
+        self.output.write(data)
+        return self.decoder.decode(data)
+
+    def close(self):
+        """Close the pipe, returning whatever was left to decode."""
+        self.pipe.close()
+        return self.decoder.decode(b'', True)
+
+_SelectorKey = collections.namedtuple('_SelectorKey', ['fileobj', 'data'])
+
+class _SelectSelector(object):
+    """Minimal stand-in for selectors.DefaultSelector using select(2).
+
+    Only used where the selectors module isn't available, it only watches
+    for readability and is subject to select's FD_SETSIZE limit.
+    """
+
+    def __init__(self):
+        self.keys = {}
+
+    def register(self, fileobj, events, data=None):
+        self.keys[fileobj] = _SelectorKey(fileobj, data)
+
+    def unregister(self, fileobj):
+        return self.keys.pop(fileobj)
+
+    def select(self, timeout=None):
+        if not self.keys:
+            time.sleep(timeout)
+            return []
+        import select
+        readable, _, _ = select.select(list(self.keys), [], [], timeout)
+        return [(self.keys[fileobj], _EVENT_READ) for fileobj in readable]
+
+    def close(self):
+        self.keys.clear()
+
+# Same as selectors.EVENT_READ
+_EVENT_READ = 1
+
+def _new_selector():
+    try:
+        import selectors
+    except ImportError:
+        # python2 doesn't have selectors, _SelectSelector stands in for it
+        return _SelectSelector()
+    return selectors.DefaultSelector()
+
+def _shell_quote(string):
+    try:
+        from shlex import quote
+    except ImportError:
+        # python2 keeps it in pipes
+        from pipes import quote
+    return quote(string)
+
+def _ssh_cmdargs(server, remote_args, ssh_options=()):
+    cmdargs = []
+    cmdargs.append('ssh')
+    cmdargs.extend(ssh_options)
+    cmdargs.append(server)
+    cmdargs.extend(remote_args)
+    return cmdargs
+
+_JobTiming = collections.namedtuple('_JobTiming', [
+    'spawned', 'first_output', 'exited', 'reaped',
+])
+
+class _Job(object):
+    """One command run on one server, and the output captured from it."""
+
+    __slots__ = ('server', 'cmd_num', 'cmd', 'proc', 'output_dir',
+                 'keep_output', 'captures', 'results', 'status', 'started_at',
+                 'first_output_at', 'exited_at', 'reaped_at', 'kill_at',
+                 'attempts')
+
+    # Whether the captured output is the output of the command as is
+    streams_output = True
+
+    def __init__(self, server, cmd_num, cmd):
+        self.server = server
+        self.cmd_num = cmd_num
+        self.cmd = cmd
+        self.proc = None
+        self.output_dir = None
+        self.keep_output = False
+        self.captures = []
+        self.results = []
+        self.status = None
+        self.started_at = None
+        self.first_output_at = None
+        self.exited_at = None
+        self.reaped_at = None
+        self.kill_at = None
+        self.attempts = 1
+
+    @property
+    def retval(self):
+        """The status the job ended with, or the return code of ssh."""
+        if self.status is not None:
+            return self.status
+        return self.proc.returncode
+
+    @property
+    def timing(self):
+        """When ssh was spawned, first wrote output, exited and was reaped."""
+        return _JobTiming(self.started_at, self.first_output_at,
+                          self.exited_at, self.reaped_at)
+
+    @property
+    def history_key(self):
+        """What the job runs, to look up how long it took before."""
+        return self.cmd
+
+    def __str__(self):
+        return 'cmd {} on {}'.format(self.cmd_num, self.server)
+
+    def _new_output(self, cmd_num, filetype, keep=None, server=None):
+        if keep is None:
+            keep = self.keep_output
+        filepath = _result_path(self.output_dir, server or self.server,
+                                cmd_num, filetype)
+        return _CapturedOutput(filepath, keep)
+
+    def _add_result(self, cmd_num, retval, stdout, stderr, server=None,
+                    attempts=None):
+        server = server or self.server
+        for output in [stdout, stderr]:
+            output.close()
+        if self.keep_output:
+            _write_retval_file(self.output_dir, server, cmd_num, retval)
+        self.results.append(_CmdResult(server, cmd_num, retval, stdout,
+                                       stderr, attempts or self.attempts))
+
+    def _spawn(self, remote_args, ssh_options, outputs, stdin=None):
+        LOG.debug("Running %s", self)
+        cmdargs = _ssh_cmdargs(self.server, remote_args, ssh_options)
+        import subprocess
+        self.proc = subprocess.Popen(cmdargs, stdin=stdin,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        stdout, stderr = outputs
+        self.captures = [_StreamCapture('stdout', self.proc.stdout, stdout),
+                         _StreamCapture('stderr', self.proc.stderr, stderr)]
+
+    def start(self, output_dir, ssh_options=(), keep_output=False):
+        self.output_dir = output_dir
+        self.keep_output = keep_output
+        self._spawn([self.cmd], ssh_options, [
+            self._new_output(self.cmd_num, 'stdout'),
+            self._new_output(self.cmd_num, 'stderr'),
+        ])
+
+    def is_done(self):
+        """Whether ssh exited and all of its output has been read.
+
+        A job that timed out is done as soon as ssh exits, whatever it left
+        behind holding its pipes open is not waited on.
+        """
+        if self.proc.poll() is None:
+            return False
+        if self.status == _STATUS_TIMEOUT:
+            return True
+        return all(capture.closed for capture in self.captures)
+
+    def finish(self):
+        self.close()
+        stdout, stderr = [capture.output for capture in self.captures]
+        self._add_result(self.cmd_num, self.retval, stdout, stderr)
+
+    def reported_jobs(self, stream_name, text):
+        """Jobs run by this one that ``text`` reports as finished."""
+        return ()
+
+    def connection_failed(self):
+        """Whether ssh exited because it couldn't connect to the server.
+
+        ssh exits with 255 when it fails to connect, as may a command. Only
+        when nothing was written to stdout, which can't happen without a
+        connection, and ssh said why it couldn't connect on stderr, is it
+        taken for a failure to connect, so that commands that ran aren't
+        run again.
+        """
+        if self.status is not None or self.proc.returncode != 255 or \
+           self.captures[0].output.size != 0:
+            return False
+        stderr_tail, _ = self.captures[1].output.tail(_SSH_ERROR_LINES)
+        return _SSH_CONNECT_ERROR_RE.search(stderr_tail) is not None
+
+    def reset(self):
+        """Discard the outcome of the last attempt to make another one."""
+        self.close()
+        for capture in self.captures:
+            capture.output.discard()
+        self.captures = []
+        self.proc = None
+        self.status = None
+        self.kill_at = None
+        self.first_output_at = None
+        self.exited_at = None
+        self.attempts += 1
+
+    def abandon(self, output_dir, status, keep_output=False):
+        """Record ``status`` as the result of the job without running it."""
+        LOG.debug("Not running %s: %s", self, status)
+        self.output_dir = output_dir
+        self.keep_output = keep_output
+        self.status = status
+        self._add_result(self.cmd_num, status,
+                         self._new_output(self.cmd_num, 'stdout'),
+                         self._new_output(self.cmd_num, 'stderr'))
+
+    def timeout(self, now):
+        """Terminate the ssh process, and kill it if it takes too long."""
+        if self.kill_at is None:
+            LOG.debug("%s timed out, terminating it", self)
+            self.status = _STATUS_TIMEOUT
+            self.kill_at = now + _KILL_GRACE
+            self.proc.terminate()
+        elif now >= self.kill_at:
+            LOG.debug("%s didn't exit after terminating it, killing it", self)
+            self.kill_at = float('inf')
+            self.proc.kill()
+
+    def close(self):
+        for capture in self.captures:
+            if not capture.closed:
+                capture.close()
+            capture.output.close()
+
+def _batch_script(numbered_cmds, marker):
+    script_lines = []
+    for cmd_num, cmd in numbered_cmds:
+        script_lines.extend(_BATCH_CMD_FORMAT.format(
+            marker=marker, cmd_num=cmd_num,
+            quoted_cmd=_shell_quote(cmd.rstrip('\n')),
+        ).splitlines())
+    return '\n'.join(script_lines) + '\n'
+
+def _split_batch_output(contents, marker):
+    """Split framed output of a batch into per-command contents.
+
+    Works on bytes, returning a dictionary of command number to
+    ``(content, retval)`` and any bytes outside of the frames, such as
+    messages from ssh itself. The retval is None if the command's end frame
+    didn't carry one (stderr frames) or if the command didn't finish before
+    the session ended.
+    """
+    begin_prefix = '{} begin '.format(marker).encode('ascii')
+    end_prefix = '{} end '.format(marker).encode('ascii')
+
+    framed = {}
+    unframed = []
+    cmd_num, cmd_lines = None, []
+    for line in contents.splitlines(True):
+        if line.startswith(begin_prefix):
+            cmd_num, cmd_lines = int(line[len(begin_prefix):]), []
+        elif cmd_num is not None and line.startswith(end_prefix):
+            end_fields = line[len(end_prefix):].split()
+            retval = int(end_fields[1]) if len(end_fields) > 1 else None
+            # The end frame is always preceded by a newline of our own
+            content = b''.join(cmd_lines)[:-1]
+            framed[cmd_num] = (content, retval,)
+            cmd_num, cmd_lines = None, []
+        elif cmd_num is not None:
+            cmd_lines.append(line)
         else:
-            def _shortened(line):
-                escaped_chars_num = sum(map(len, re.findall('\x1b\[.*?m', line)))
-                if term_columns+escaped_chars_num >= len(line):
-                    return line
-                return line[:term_columns+escaped_chars_num-3]+'...'
-        output_lines = [_shortened(line)
-                        if len(line) > term_columns else line
-                        for line in output_lines]
-
-    report = '\n'.join(output_lines)
-
-    print(report)
-
-def remote_execute(servers, commands, output_dir, ssh_config=None):
-    run_queue = itertools.product(
-        servers,
-        enumerate(itertools.chain(*commands.values()), 1)
+            unframed.append(line)
+
+    if cmd_num is not None:
+        framed[cmd_num] = (b''.join(cmd_lines), None,)
+
+    return framed, b''.join(unframed)
+
+class _BatchJob(_Job):
+    """All commands for one server run in order over a single ssh session.
+
+    The commands are fed as a script to a remote ``sh -s`` that frames the
+    output of each of them with a random marker. When the session ends the
+    framed output is split into the usual per-command results. Commands
+    that didn't get to report a return value get the one from ssh, along
+    with whatever ssh wrote outside of the frames on stderr.
+    """
+
+    __slots__ = ('numbered_cmds', 'marker')
+
+    streams_output = False
+
+    def __init__(self, server, numbered_cmds):
+        super(_BatchJob, self).__init__(server, 'batch', None)
+        self.numbered_cmds = numbered_cmds
+        import uuid
+        self.marker = 'POH-{}'.format(uuid.uuid4().hex)
+
+    def __str__(self):
+        return 'batch of {} cmds on {}'.format(len(self.numbered_cmds),
+                                               self.server)
+
+    @property
+    def history_key(self):
+        return '\n'.join(cmd for _, cmd in self.numbered_cmds)
+
+    def start(self, output_dir, ssh_options=(), keep_output=False):
+        self.output_dir = output_dir
+        self.keep_output = keep_output
+        scriptpath = _result_path(output_dir, self.server, 'batch', 'sh')
+        with open(scriptpath, 'w') as scriptfile:
+            scriptfile.write(_batch_script(self.numbered_cmds, self.marker))
+
+        with open(scriptpath, 'r') as scriptfile:
+            os.remove(scriptpath)
+            # The framed output is split up when done, never kept as is
+            self._spawn(['sh', '-s'], ssh_options, [
+                self._new_output('batch', 'stdout', keep=False),
+                self._new_output('batch', 'stderr', keep=False),
+            ], stdin=scriptfile)
+
+    def finish(self):
+        self.close()
+        framed_stdout, framed_stderr = [capture.output
+                                        for capture in self.captures]
+        stdouts, unframed_stdout = _split_batch_output(framed_stdout.data(),
+                                                       self.marker)
+        stderrs, unframed_stderr = _split_batch_output(framed_stderr.data(),
+                                                       self.marker)
+        framed_stdout.discard()
+        framed_stderr.discard()
+
+        for cmd_num, _ in self.numbered_cmds:
+            stdout_data, retval = stdouts.get(cmd_num, (b'', None,))
+            stderr_data, _ = stderrs.get(cmd_num, (b'', None,))
+            if retval is None:
+                retval = self.retval
+                stdout_data = unframed_stdout + stdout_data
+                stderr_data = unframed_stderr + stderr_data
+            stdout = self._new_output(cmd_num, 'stdout')
+            stdout.write(stdout_data)
+            stderr = self._new_output(cmd_num, 'stderr')
+            stderr.write(stderr_data)
+            self._add_result(cmd_num, retval, stdout, stderr)
+
+    def abandon(self, output_dir, status, keep_output=False):
+        LOG.debug("Not running %s: %s", self, status)
+        self.output_dir = output_dir
+        self.keep_output = keep_output
+        self.status = status
+        for cmd_num, _ in self.numbered_cmds:
+            self._add_result(cmd_num, status,
+                             self._new_output(cmd_num, 'stdout'),
+                             self._new_output(cmd_num, 'stderr'))
+
+def _poh_source():
+    """Source of this very file, to be run as is on relays."""
+    source_path = __file__
+    if source_path.endswith(('.pyc', '.pyo')):
+        source_path = source_path[:-1]
+    with io.open(source_path, 'r', encoding='utf-8') as source_file:
+        return source_file.read()
+
+def _relay_remote_cmd(relay_args):
+    return 'exec "$(command -v python3 || command -v python)" -c {} {}'.format(
+        _shell_quote(_RELAY_BOOTSTRAP),
+        ' '.join(_shell_quote(arg) for arg in relay_args)
     )
 
-    result_files = []
-    child_procs = []
+class _DiscardedOutput(object):
+    """Output of a stream that's only looked at as it's read, not kept."""
+
+    __slots__ = ('size',)
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def close(self):
+        pass
+
+    def discard(self):
+        pass
+
+class _ReportedJob(object):
+    """A command a relay ran, made up from the result it reported."""
+
+    __slots__ = ('server', 'cmd_num', 'attempts', 'timing', 'results')
+
+    # Nothing is known of these jobs but their results, which are only
+    # written once they're complete
+    status = None
+    history_key = None
+    streams_output = False
+
+    def __init__(self, result, timing):
+        self.server = result.server
+        self.cmd_num = result.cmd_num
+        self.attempts = result.attempts
+        self.timing = timing
+        self.results = [result]
+
+    @property
+    def retval(self):
+        return self.results[0].retval
+
+    def __str__(self):
+        return 'cmd {} on {}, run by a relay'.format(self.cmd_num,
+                                                     self.server)
+
+    def connection_failed(self):
+        return False
+
+def _reported_timing(record):
+    timing = record.get('timing')
+    if not isinstance(timing, dict):
+        return _JobTiming(None, None, None, None)
+    return _JobTiming(*[timing.get(name) for name in _JobTiming._fields])
+
+class _RelayJob(_Job):
+    """All commands for a shard of the servers, run by poh on a relay.
+
+    A copy of poh is fed to the relay's python on stdin, followed by the
+    servers of the shard for it to read as it does when run by hand. It
+    runs the commands with ``relay_args`` and writes a line of JSON for
+    every result, which is turned into a job of its own as soon as it's
+    read, rather than keeping what the relay writes. Results that didn't
+    get reported by the time the relay is done are UNREPORTED, with what
+    the relay wrote on stderr.
+    """
+
+    __slots__ = ('servers', 'server_set', 'numbered_cmds', 'relay_args',
+                 'pending_line', 'reported')
+
+    streams_output = False
+
+    def __init__(self, relay, servers, numbered_cmds, relay_args):
+        super(_RelayJob, self).__init__(relay, 'relay', None)
+        self.servers = servers
+        self.server_set = set(servers)
+        self.numbered_cmds = numbered_cmds
+        self.relay_args = relay_args
+        self.pending_line = ''
+        self.reported = set()
+
+    def __str__(self):
+        return 'relay of {} servers through {}'.format(len(self.servers),
+                                                       self.server)
+
+    @property
+    def history_key(self):
+        # How long a relay takes has more to do with its servers than with it
+        return None
+
+    def start(self, output_dir, ssh_options=(), keep_output=False):
+        self.output_dir = output_dir
+        self.keep_output = keep_output
+        source = _poh_source()
+        if not source.endswith('\n'):
+            source += '\n'
+        inputpath = _result_path(output_dir, self.server, 'relay', 'in')
+        with io.open(inputpath, 'w', encoding='utf-8') as inputfile:
+            inputfile.write(u'{}\n'.format(source.count('\n')))
+            inputfile.write(source)
+            inputfile.writelines(u'{}\n'.format(server)
+                                 for server in self.servers)
+
+        relay_args = self.relay_args + ['--'] + [
+            cmd for _, cmd in self.numbered_cmds
+        ]
+        with open(inputpath, 'rb') as inputfile:
+            os.remove(inputpath)
+            # Results are turned into per-command ones as they're read,
+            # what the relay writes on stdout is never kept as is
+            self._spawn([_relay_remote_cmd(relay_args)], ssh_options, [
+                _DiscardedOutput(),
+                self._new_output('relay', 'stderr', keep=False),
+            ], stdin=inputfile)
+
+    def _valid_record(self, record):
+        if not isinstance(record, dict):
+            return False
+        cmd_num, retval = record.get('cmd_num'), record.get('retval')
+        return record.get('server') in self.server_set and \
+            isinstance(cmd_num, int) and \
+            1 <= cmd_num <= len(self.numbered_cmds) and \
+            (isinstance(retval, int) or retval in _STATUSES) and \
+            isinstance(record.get('stdout'), _TEXT_TYPE) and \
+            isinstance(record.get('stderr'), _TEXT_TYPE)
+
+    def _reported_job(self, line):
+        """The job reported by a line of JSON, None if it isn't one."""
+        import json
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not self._valid_record(record):
+            LOG.warning("Ignoring what %s reported that isn't a result: %r",
+                        self, line[:_REPORTED_LINE_CHARS])
+            return None
+        # The relay numbers the commands it was given from 1
+        server = record['server']
+        cmd_num = self.numbered_cmds[record['cmd_num'] - 1][0]
+        if (server, cmd_num,) in self.reported:
+            LOG.warning("Ignoring result of cmd %d on %s reported again by"
+                        " %s", cmd_num, server, self)
+            return None
+        stdout = self._new_output(cmd_num, 'stdout', server=server)
+        stdout.write(record['stdout'].encode('utf-8'))
+        stderr = self._new_output(cmd_num, 'stderr', server=server)
+        stderr.write(record['stderr'].encode('utf-8'))
+        for output in [stdout, stderr]:
+            output.close()
+        if self.keep_output:
+            _write_retval_file(self.output_dir, server, cmd_num,
+                               record['retval'])
+        self.reported.add((server, cmd_num,))
+        result = _CmdResult(server, cmd_num, record['retval'], stdout,
+                            stderr, record.get('attempts', 1))
+        return _ReportedJob(result, _reported_timing(record))
+
+    def reported_jobs(self, stream_name, text):
+        if stream_name != 'stdout' or not text:
+            return []
+        lines = (self.pending_line + text).split('\n')
+        self.pending_line = lines.pop()
+        reported_jobs = [self._reported_job(line) for line in lines
+                         if line.strip()]
+        return [job for job in reported_jobs if job is not None]
+
+    def reset(self):
+        super(_RelayJob, self).reset()
+        self.pending_line = ''
+
+    def finish(self):
+        self.close()
+        relay_stderr = self.captures[1].output
+        relay_stderr_data = relay_stderr.data()
+        relay_stderr.discard()
+
+        # What the relay got on other commands says nothing of these
+        status = self.status or _STATUS_UNREPORTED
+        note = u'poh: {} exited with {} without reporting this result\n'
+        note = note.format(self.server, self.retval).encode('utf-8')
+        for server in self.servers:
+            for cmd_num, _ in self.numbered_cmds:
+                if (server, cmd_num,) in self.reported:
+                    continue
+                stdout = self._new_output(cmd_num, 'stdout', server=server)
+                stderr = self._new_output(cmd_num, 'stderr', server=server)
+                stderr.write(note)
+                stderr.write(relay_stderr_data)
+                self._add_result(cmd_num, status, stdout, stderr,
+                                 server=server)
+
+    def abandon(self, output_dir, status, keep_output=False):
+        LOG.debug("Not running %s: %s", self, status)
+        self.output_dir = output_dir
+        self.keep_output = keep_output
+        self.status = status
+        for server in self.servers:
+            for cmd_num, _ in self.numbered_cmds:
+                self._add_result(
+                    cmd_num, status,
+                    self._new_output(cmd_num, 'stdout', server=server),
+                    self._new_output(cmd_num, 'stderr', server=server),
+                    server=server
+                )
+
+class _ControlJob(_Job):
+    """An ssh invocation managing the control master of one server."""
+
+    __slots__ = ('action', 'ctl_options')
+
+    def __init__(self, server, action, ctl_options):
+        super(_ControlJob, self).__init__(server, None, None)
+        self.action = action
+        self.ctl_options = ctl_options
+
+    def __str__(self):
+        return 'control master {} for {}'.format(self.action, self.server)
+
+    def start(self, output_dir, ssh_options=(), keep_output=False):
+        LOG.debug("Running %s", self)
+        cmdargs = _ssh_cmdargs(self.server, [],
+                               list(ssh_options) + self.ctl_options)
+        import subprocess
+        with open(os.devnull, 'r+') as devnull:
+            self.proc = subprocess.Popen(cmdargs, stdin=devnull,
+                                         stdout=devnull, stderr=devnull)
+
+    def finish(self):
+        if self.status is not None:
+            LOG.debug("%s ended with %s, %s is connected to directly", self,
+                      self.status, self.server)
+        elif self.retval != 0:
+            LOG.debug("%s failed with %s", self, self.retval)
+
+    def abandon(self, output_dir, status, keep_output=False):
+        LOG.debug("Not running %s: %s", self, status)
+        self.status = status
+
+class _ControlMasterPool(object):
+    """OpenSSH control master connections for the servers of a run.
+
+    One master per server is opened (or a live one from a previous run
+    reused) before running commands, with at most ``max_parallel`` ssh
+    processes doing so at once. Sessions then multiplex over the masters'
+    sockets in ``control_dir``. Servers whose master couldn't be opened
+    have no socket, so their sessions just connect directly. That includes
+    those whose master took longer than ``timeout`` seconds to open, which
+    would otherwise hold up every command of the run.
+
+    With a ``persist`` of 0 the masters are closed by :meth:`close`,
+    otherwise they're left to exit on their own after ``persist`` seconds
+    without sessions so that later runs can reuse them.
+    """
+
+    def __init__(self, control_dir, ssh_options=(), persist=0,
+                 max_parallel=_DEFAULT_MAX_PARALLEL, timeout=None):
+        self.control_path = os.path.join(control_dir, '%C')
+        self.ssh_options = ssh_options
+        self.persist = persist
+        self.max_parallel = max_parallel
+        self.timeout = timeout
+
+    def _control_job(self, server, action, extra_options=()):
+        ctl_options = ['-o', 'ControlPath={}'.format(self.control_path)]
+        ctl_options.extend(extra_options)
+        return _ControlJob(server, action, ctl_options)
+
+    def _open_lane(self, server):
+        check = self._control_job(server, 'check', ['-O', 'check'])
+        yield check
+        if check.retval == 0:
+            LOG.debug("Reusing live control master for %s", server)
+            return
+        yield self._control_job(server, 'open', [
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPersist={}'.format(self.persist or 'no'),
+            '-N', '-f',
+        ])
+
+    def _run(self, lanes, deadline=None):
+        scheduler = _JobScheduler(None, self.ssh_options, self.max_parallel,
+                                  timeout=self.timeout, deadline=deadline)
+        scheduler.run(lanes)
+
+    def open(self, servers, deadline=None):
+        self._run((self._open_lane(server) for server in servers), deadline)
+
+    def close(self, servers):
+        if self.persist:
+            LOG.debug("Leaving control masters to persist for %ds",
+                      self.persist)
+            return
+        self._run([self._control_job(server, 'exit', ['-O', 'exit'])]
+                  for server in servers)
+
+    def session_options(self):
+        return ['-o', 'ControlMaster=no',
+                '-o', 'ControlPath={}'.format(self.control_path)]
+
+def _control_dir(output_dir, persist):
+    if persist:
+        control_dir = os.path.expanduser(_PERSISTENT_CONTROL_DIR)
+    else:
+        control_dir = os.path.join(output_dir, 'control')
+    if not os.path.isdir(control_dir):
+        os.makedirs(control_dir, mode=0o700)
+    return control_dir
+
+class _JobScheduler(object):
+    """Run lanes of jobs keeping at most ``max_parallel`` of them at once.
+
+    A lane is an iterable of jobs that have to run one after the other,
+    every lane occupies one slot while it has jobs left. When a job is
+    reaped its result files are closed and the next job of its lane takes
+    the slot, or the next pending lane if it was the last one. The number
+    of child processes and open files is thus bounded by ``max_parallel``
+    no matter how many jobs are scheduled. A ``max_parallel`` of 0 (or None)
+    means no limit.
+
+    The output of all running jobs is read through a single selector as it
+    arrives, ``on_output(job, stream_name, text)`` is called with every
+    piece of it and ``on_finish(job)`` once a job has been reaped, or
+    ``iter_run`` yields the job then. Output is
+    kept in memory unless ``keep_output`` is set, or it grows too large,
+    in which case it's written to result files in ``output_dir``.
+
+    Jobs running for longer than ``timeout`` seconds are terminated, and
+    killed if they don't exit within a grace period, ending up with a
+    TIMEOUT status. Once the ``deadline`` timestamp passes the same happens
+    to every running job, and jobs that didn't get to start are recorded
+    with a TIMEOUT status without running them.
+
+    Jobs whose ssh failed to connect are run again up to ``retries`` more
+    times, as long as the run made fewer than ``retry_budget`` retries in
+    all (or there's no budget). Each retry waits for a random time of up to
+    ``retry_backoff`` seconds, doubling on every attempt, keeping the slot
+    of its lane in the meantime.
+
+    Jobs that run others, as relays do, may report those finished in their
+    output, and each of them is finished as a job of its own right away.
+    """
+
+    def __init__(self, output_dir, ssh_options=(),
+                 max_parallel=_DEFAULT_MAX_PARALLEL, timeout=None,
+                 deadline=None, on_output=None, on_finish=None,
+                 keep_output=False, retries=0, retry_budget=None,
+                 retry_backoff=_DEFAULT_RETRY_BACKOFF):
+        self.output_dir = output_dir
+        self.keep_output = keep_output
+        self.ssh_options = ssh_options
+        self.max_parallel = max_parallel
+        self.timeout = timeout
+        self.deadline = deadline
+        self.on_output = on_output
+        self.on_finish = on_finish
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.retry_backoff = retry_backoff
+        self.retries_made = 0
+        self.running = []
+        self.waiting = []
+        self.finished = collections.deque()
+        self.selector = None
+
+    def _has_free_slot(self):
+        return not self.max_parallel or \
+            len(self.running) + len(self.waiting) < self.max_parallel
+
+    def _past_deadline(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+    def _finish(self, job):
+        if self.on_finish is not None:
+            self.on_finish(job)
+        self.finished.append(job)
+
+    def _abandon(self, jobs, status=_STATUS_TIMEOUT):
+        for job in jobs:
+            job.abandon(self.output_dir, status, self.keep_output)
+            self._finish(job)
+
+    def skip(self, lanes):
+        """Record every job of ``lanes`` as SKIPPED without running it."""
+        for lane in lanes:
+            self._abandon(lane, _STATUS_SKIPPED)
+
+    def pop_finished(self):
+        """Jobs finished since last called, in the order they finished."""
+        while self.finished:
+            yield self.finished.popleft()
+
+    def _start_next(self, lane):
+        job = next(lane, None)
+        if job is None:
+            return
+        if self._past_deadline(time.time()):
+            self._abandon(itertools.chain([job], lane))
+            return
+        self._start(job, lane)
+
+    def _start(self, job, lane):
+        job.start(self.output_dir, self.ssh_options, self.keep_output)
+        job.started_at = time.time()
+        for capture in job.captures:
+            self.selector.register(capture, _EVENT_READ, job)
+        self.running.append((job, lane,))
+
+    def _should_retry(self, job):
+        if job.attempts > self.retries or not job.connection_failed():
+            return False
+        return self.retry_budget is None or \
+            self.retries_made < self.retry_budget
+
+    def _retry_later(self, job, lane, now):
+        import random
+        backoff = min(_RETRY_BACKOFF_CAP,
+                      self.retry_backoff * 2 ** (job.attempts - 1))
+        delay = random.uniform(0, backoff)
+        LOG.debug("%s failed to connect, retrying in %0.3fs", job, delay)
+        self.retries_made += 1
+        job.reset()
+        self.waiting.append((now + delay, job, lane,))
+
+    def _start_waiting(self, now):
+        """Start the retries that are due, or abandon them if past deadline.
+
+        Returns whether any was abandoned, freeing up its slot.
+        """
+        still_waiting = []
+        abandoned = False
+        for retry_at, job, lane in self.waiting:
+            if self._past_deadline(now):
+                self._abandon(itertools.chain([job], lane))
+                abandoned = True
+            elif now >= retry_at:
+                self._start(job, lane)
+            else:
+                still_waiting.append((retry_at, job, lane,))
+        self.waiting = still_waiting
+        return abandoned
+
+    def _timed_out(self, job, now):
+        if job.kill_at is not None or self._past_deadline(now):
+            return True
+        return bool(self.timeout) and now - job.started_at >= self.timeout
+
+    def _output_read(self, job, stream_name, text):
+        if text and self.on_output is not None:
+            self.on_output(job, stream_name, text)
+        for reported_job in job.reported_jobs(stream_name, text):
+            self._finish(reported_job)
+
+    def _close_capture(self, job, capture):
+        self.selector.unregister(capture)
+        self._output_read(job, capture.name, capture.close())
+
+    def _read_output(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            capture, job = key.fileobj, key.data
+            text = capture.read()
+            if text is not None and job.first_output_at is None:
+                job.first_output_at = time.time()
+            if text is None:
+                self._close_capture(job, capture)
+            else:
+                self._output_read(job, capture.name, text)
+
+    def _reap(self):
+        """Block until at least one running job is done and finish those."""
+        while True:
+            if self._start_waiting(time.time()):
+                return
+            if not self.running:
+                if not self.waiting:
+                    return
+                wake_at = min(retry_at for retry_at, _, _ in self.waiting)
+                if self.deadline is not None:
+                    wake_at = min(wake_at, self.deadline)
+                time.sleep(max(0, wake_at - time.time()))
+                continue
+            self._read_output(_POLL_INTERVAL)
+            finished = []
+            still_running = []
+            now = time.time()
+            for job, lane in self.running:
+                done = job.is_done()
+                if job.exited_at is None and job.proc.returncode is not None:
+                    job.exited_at = now
+                if done:
+                    finished.append((job, lane,))
+                else:
+                    if job.proc.returncode is None and \
+                       self._timed_out(job, now):
+                        job.timeout(now)
+                    still_running.append((job, lane,))
+            if finished or self.finished:
+                break
+
+        self.running = still_running
+        for job, lane in finished:
+            for capture in job.captures:
+                if not capture.closed:
+                    self._close_capture(job, capture)
+            LOG.debug("%s exited with %s", job, job.retval)
+            if self._should_retry(job):
+                self._retry_later(job, lane, now)
+                continue
+            job.reaped_at = time.time()
+            job.finish()
+            self._finish(job)
+            self._start_next(lane)
+
+    def run(self, lanes):
+        for _ in self.iter_run(lanes):
+            pass
+
+    def iter_run(self, lanes):
+        """Run ``lanes``, yielding every job once it's finished.
 
+        Jobs still running when the iteration is stopped early are killed.
+        """
+        self.selector = _new_selector()
+        try:
+            for lane in lanes:
+                while not self._has_free_slot():
+                    self._reap()
+                    for job in self.pop_finished():
+                        yield job
+                self._start_next(iter(lane))
+                for job in self.pop_finished():
+                    yield job
+
+            while self.running or self.waiting:
+                self._reap()
+                for job in self.pop_finished():
+                    yield job
+        except GeneratorExit:
+            # Nobody is left to wait for what the running jobs get
+            for job, _ in self.running:
+                if job.proc.poll() is None:
+                    job.proc.kill()
+                    job.proc.wait()
+            raise
+        finally:
+            for job, _ in self.running:
+                for capture in job.captures:
+                    if not capture.closed:
+                        self.selector.unregister(capture)
+                job.close()
+            self.running = []
+            self.waiting = []
+            self.selector.close()
+
+def _server_cmds(numbered_cmds, server, pending=None):
+    """Numbered commands to run on ``server``, those ``pending`` if given."""
+    if pending is None:
+        return numbered_cmds
+    return [(cmd_num, cmd) for cmd_num, cmd in numbered_cmds
+            if cmd_num in pending[server]]
+
+def _parallel_lanes(servers, commands, pending=None):
+    numbered_cmds = list(enumerate(itertools.chain(*commands.values()), 1))
+    for server in servers:
+        for cmd_num, cmd in _server_cmds(numbered_cmds, server, pending):
+            yield [_Job(server, cmd_num, cmd)]
+
+def _pipeline_lane(server, numbered_cmds):
+    # Jobs are only made as the lane gets to them
+    for cmd_num, cmd in numbered_cmds:
+        yield _Job(server, cmd_num, cmd)
+
+def _pipeline_lanes(servers, commands, pending=None):
+    numbered_cmds = list(enumerate(itertools.chain(*commands.values()), 1))
+    for server in servers:
+        yield _pipeline_lane(server, _server_cmds(numbered_cmds, server,
+                                                  pending))
+
+def _batch_lanes(servers, commands, pending=None):
+    numbered_cmds = list(enumerate(itertools.chain(*commands.values()), 1))
+    for server in servers:
+        yield [_BatchJob(server, _server_cmds(numbered_cmds, server,
+                                              pending))]
+
+def _relay_lanes(relays, servers, commands, relay_args, pending=None):
+    numbered_cmds = list(enumerate(itertools.chain(*commands.values()), 1))
+    # Relays run the same commands on all of their servers
+    servers_by_cmds = collections.OrderedDict()
+    for server in servers:
+        server_cmds = tuple(_server_cmds(numbered_cmds, server, pending))
+        servers_by_cmds.setdefault(server_cmds, []).append(server)
+    for server_cmds, cmds_servers in servers_by_cmds.items():
+        for relay_num, relay in enumerate(relays):
+            shard = cmds_servers[relay_num::len(relays)]
+            if shard:
+                yield [_RelayJob(relay, shard, list(server_cmds),
+                                 relay_args)]
+
+def _relay_args(max_parallel, exec_mode, control_master, control_persist,
+                timeout, run_timeout, retries, retry_budget, retry_backoff):
+    """Arguments for poh on relays, to run commands as it's run here."""
+    # Relays are left without a history of their own
+    relay_args = ['--json', '--no-history', '--max-parallel',
+                  str(max_parallel or 0), '--exec-mode', exec_mode]
+    if control_master:
+        relay_args.append('--control-master')
+    if control_persist:
+        relay_args.extend(['--control-persist', str(control_persist)])
+    if timeout:
+        relay_args.extend(['--timeout', repr(timeout)])
+    if run_timeout:
+        relay_args.extend(['--run-timeout', repr(run_timeout)])
+    if retries:
+        relay_args.extend(['--retries', str(retries),
+                           '--retry-backoff', repr(retry_backoff)])
+    if retry_budget is not None:
+        relay_args.extend(['--retry-budget', str(retry_budget)])
+    return relay_args
+
+_LANE_BUILDERS = collections.OrderedDict([
+    ('parallel', _parallel_lanes),
+    ('pipeline', _pipeline_lanes),
+    ('batch', _batch_lanes),
+])
+
+def remote_execute(servers, commands, output_dir, ssh_config=None,
+                   max_parallel=_DEFAULT_MAX_PARALLEL,
+                   exec_mode=_DEFAULT_EXEC_MODE, control_master=False,
+                   control_persist=0, timeout=None, run_timeout=None,
+                   on_output=None, on_finish=None, keep_output=True,
+                   pack_output=False, compress_output=False, retries=0,
+                   retry_budget=None, retry_backoff=_DEFAULT_RETRY_BACKOFF,
+                   relays=None, rolling=None, max_failures=0, pending=None,
+                   history=None):
+    results = []
+    for job in _finished_jobs(servers, commands, output_dir, ssh_config,
+                              max_parallel, exec_mode, control_master,
+                              control_persist, timeout, run_timeout,
+                              on_output, on_finish, keep_output, pack_output,
+                              compress_output, retries, retry_budget,
+                              retry_backoff, relays, rolling, max_failures,
+                              pending, history):
+        results.extend(job.results)
+    return results
+
+def _finished_jobs(servers, commands, output_dir, ssh_config=None,
+                   max_parallel=_DEFAULT_MAX_PARALLEL,
+                   exec_mode=_DEFAULT_EXEC_MODE, control_master=False,
+                   control_persist=0, timeout=None, run_timeout=None,
+                   on_output=None, on_finish=None, keep_output=True,
+                   pack_output=False, compress_output=False, retries=0,
+                   retry_budget=None, retry_backoff=_DEFAULT_RETRY_BACKOFF,
+                   relays=None, rolling=None, max_failures=0, pending=None,
+                   history=None):
+    """Run commands as remote_execute does, yielding jobs as they finish."""
+    failed_servers = set()
+    manifest = None
+    pack = None
+    if keep_output:
+        manifest = _ResultManifest(output_dir, commands)
+        if pack_output:
+            pack = _ResultPack(output_dir, compress_output)
+
+    def _collect_results(job):
+        if pack is not None:
+            job.results = [pack.pack(result) for result in job.results]
+        failed_servers.update(result.server for result in job.results
+                              if result.retval != 0)
+        if manifest is not None:
+            for result in job.results:
+                manifest.add(result, job.timing)
+        if on_finish is not None:
+            on_finish(job)
+
+    deadline = None
+    if run_timeout:
+        deadline = time.time() + run_timeout
+
+    ssh_options = []
+    if ssh_config:
+        ssh_options.append('-F{}'.format(ssh_config))
+
+    relay_args = None
+    if relays:
+        # Relays run the commands with these options themselves, and are
+        # given a while past the end of the run to report what they got
+        relay_args = _relay_args(max_parallel, exec_mode, control_master,
+                                 control_persist, timeout, run_timeout,
+                                 retries, retry_budget, retry_backoff)
+        control_master = False
+        timeout = None
+        if deadline is not None:
+            deadline += _RELAY_GRACE
+
+    batches = [servers]
+    failures_allowed = None
+    if rolling:
+        servers = list(servers)
+        batch_size = max(1, int(math.ceil(_servers_count(rolling,
+                                                         len(servers)))))
+        batches = [servers[start:start + batch_size]
+                   for start in range(0, len(servers), batch_size)]
+        failures_allowed = _servers_count(max_failures or 0, len(servers))
+
+    pool = None
+    opened_servers = []
+    if control_master:
+        pool = _ControlMasterPool(_control_dir(output_dir, control_persist),
+                                  ssh_options, control_persist, max_parallel,
+                                  timeout)
+        ssh_options = ssh_options + pool.session_options()
+
+    def _lanes(batch):
+        if relays:
+            lanes = _relay_lanes(relays, batch, commands, relay_args, pending)
+        else:
+            lanes = _LANE_BUILDERS[exec_mode](batch, commands, pending)
+        if history is not None:
+            lanes = history.ordered(lanes)
+        return lanes
+
+    # Packed outputs are kept in the pack rather than in result files
+    scheduler = _JobScheduler(output_dir, ssh_options, max_parallel,
+                              timeout, deadline, on_output, _collect_results,
+                              keep_output and pack is None, retries,
+                              retry_budget, retry_backoff)
     try:
-        for server, (cmd_num, cmd) in run_queue:
+        stopped = False
+        for batch_num, batch in enumerate(batches, 1):
+            if not stopped and failures_allowed is not None and \
+               len(failed_servers) > failures_allowed:
+                LOG.warning("Commands failed on %d servers, skipping the"
+                            " last %d of %d batches", len(failed_servers),
+                            len(batches) - batch_num + 1, len(batches))
+                stopped = True
+            if stopped:
+                scheduler.skip(_lanes(batch))
+                for job in scheduler.pop_finished():
+                    yield job
+                continue
+            if pool is not None:
+                batch = list(batch)
+                pool.open(batch, deadline)
+                opened_servers.extend(batch)
+            for job in scheduler.iter_run(_lanes(batch)):
+                yield job
+    finally:
+        if pool is not None:
+            pool.close(opened_servers)
+        if manifest is not None:
+            manifest.close()
+        if pack is not None:
+            pack.close()
+
+_JobMetrics = collections.namedtuple('_JobMetrics', [
+    'server', 'cmd_num', 'retval', 'attempts', 'timing', 'stdout_bytes',
+    'stderr_bytes',
+])
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of values that are already sorted."""
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+def _distribution(values):
+    values = sorted(values)
+    return collections.OrderedDict(
+        [('p{}'.format(percent), _percentile(values, percent))
+         for percent in _PERCENTILES] +
+        [('max', values[-1] if values else None)]
+    )
 
-            rvpath, outpath, errpath = [
-                os.path.join(output_dir,
-                             '.'.join([server, str(cmd_num), filetype]))
-                for filetype in ['retval', 'stdout', 'stderr']
-            ]
-            rvfile, outfile, errfile = [open(filepath, 'w') for filepath in [
-                rvpath, outpath, errpath
-            ]]
-            result_files.extend([rvfile, outfile, errfile])
-
-            LOG.debug("Running cmd %d on %s", cmd_num, server)
-            cmdargs = []
-            cmdargs.append('ssh')
-            if ssh_config:
-                cmdargs.append('-F{}'.format(ssh_config))
-            cmdargs.extend([server, cmd])
-            child_procs.append(
-                (rvfile,
-                 subprocess.Popen(cmdargs, stdout=outfile, stderr=errfile),)
+class _RunMetrics(object):
+    """Timing of every job of a run, and aggregates of them.
+
+    Jobs are added through ``on_finish`` as they're reaped. Their latency
+    is counted from spawning ssh until it exits, and they count towards the
+    concurrency of the run from spawning ssh until being reaped. Jobs that
+    never ran only count towards the number of jobs. Relays aren't jobs of
+    their own, the jobs they report are added as any other, and those they
+    didn't report as jobs that never ran.
+    """
+
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.end_time = None
+        self.jobs = []
+
+    def on_finish(self, job):
+        if isinstance(job, _RelayJob):
+            not_run = _JobTiming(None, None, None, None)
+            self.jobs.extend(
+                _JobMetrics(result.server, result.cmd_num, result.retval,
+                            result.attempts, not_run, result.stdout.size,
+                            result.stderr.size)
+                for result in job.results
             )
+            return
+        self.jobs.append(_JobMetrics(
+            job.server, job.cmd_num, job.retval, job.attempts, job.timing,
+            sum(result.stdout.size for result in job.results),
+            sum(result.stderr.size for result in job.results),
+        ))
 
-        for rvfile, childproc in child_procs:
-            childproc.communicate()
-            rvfile.write('{:d}\n'.format(childproc.returncode))
+    def close(self, end_time):
+        self.end_time = end_time
+
+    def _latencies(self):
+        return [(job.timing.exited - job.timing.spawned, job,)
+                for job in self.jobs
+                if None not in (job.timing.spawned, job.timing.exited)]
+
+    def concurrency(self):
+        """Jobs running over time, as (seconds into the run, jobs) pairs.
+
+        There's a pair for every time the number of running jobs changed.
+        """
+        changes = []
+        for job in self.jobs:
+            if None not in (job.timing.spawned, job.timing.reaped):
+                changes.append((job.timing.spawned, 1,))
+                changes.append((job.timing.reaped, -1,))
+        changes.sort()
+
+        running = 0
+        concurrency = []
+        for timestamp, change in changes:
+            running += change
+            offset = timestamp - self.start_time
+            if concurrency and concurrency[-1][0] == offset:
+                concurrency[-1] = (offset, running,)
+            else:
+                concurrency.append((offset, running,))
+        return concurrency
+
+    def summary(self, slowest=_SLOWEST_JOBS):
+        end_time = self.end_time or time.time()
+        latencies = self._latencies()
+        concurrency = self.concurrency()
+
+        running_time = 0.0
+        for (offset, running), (next_offset, _) in zip(concurrency,
+                                                       concurrency[1:]):
+            running_time += running * (next_offset - offset)
+        duration = end_time - self.start_time
+        slowest_latencies = sorted(latencies, key=operator.itemgetter(0),
+                                   reverse=True)[:slowest]
+
+        return collections.OrderedDict([
+            ('start_time', self.start_time),
+            ('end_time', end_time),
+            ('duration', duration),
+            ('jobs', len(self.jobs)),
+            ('jobs_run', len(latencies)),
+            ('retries', sum(job.attempts - 1 for job in self.jobs)),
+            ('latency', _distribution(latency for latency, _ in latencies)),
+            ('first_output', _distribution(
+                job.timing.first_output - job.timing.spawned
+                for job in self.jobs
+                if None not in (job.timing.spawned, job.timing.first_output)
+            )),
+            ('max_concurrency', max([running for _, running in concurrency]
+                                    or [0])),
+            ('mean_concurrency', running_time / duration if duration else 0),
+            ('stdout_bytes', sum(job.stdout_bytes for job in self.jobs)),
+            ('stderr_bytes', sum(job.stderr_bytes for job in self.jobs)),
+            ('slowest', [
+                collections.OrderedDict([
+                    ('server', job.server),
+                    ('cmd_num', job.cmd_num),
+                    ('retval', job.retval),
+                    ('latency', latency),
+                ])
+                for latency, job in slowest_latencies
+            ]),
+        ])
 
-    finally:
-        for result_file in result_files:
-            try:
-                result_file.close()
-            except IOError:
-                LOG.exception("Failed to close fd %r", result_file)
+    def summary_lines(self, color=False):
+        summary = self.summary()
+        def _seconds(seconds):
+            return '-' if seconds is None else '{:0.3f}s'.format(seconds)
+        def _distribution_string(distribution):
+            return ' / '.join(_seconds(value)
+                              for value in distribution.values())
+        distribution_names = '/'.join(summary['latency'].keys())
+
+        output_lines = ['']
+        if color:
+            output_lines.append(_escaped_with("Timing summary:", ['fg_white']))
+        else:
+            output_lines.append("Timing summary:")
+        output_lines.extend([
+            "  Jobs run = {} of {}, after {} retries".format(
+                summary['jobs_run'], summary['jobs'], summary['retries']
+            ),
+            "  Latency {} = {}".format(
+                distribution_names,
+                _distribution_string(summary['latency'])
+            ),
+            "  First output {} = {}".format(
+                distribution_names,
+                _distribution_string(summary['first_output'])
+            ),
+            "  Concurrency max/mean = {} / {:0.1f}".format(
+                summary['max_concurrency'], summary['mean_concurrency']
+            ),
+            "  Captured = {} bytes of stdout, {} bytes of stderr".format(
+                summary['stdout_bytes'], summary['stderr_bytes']
+            ),
+        ])
+        if summary['slowest']:
+            output_lines.append("  Slowest jobs:")
+            output_lines.extend([
+                "    {:>10s}  {} cmd#{} {}".format(
+                    _seconds(job['latency']), job['server'], job['cmd_num'],
+                    _formatted_retval(job['retval'], color)
+                )
+                for job in summary['slowest']
+            ])
+        return output_lines
+
+def _metrics_json(metrics):
+    import json
+    report = metrics.summary()
+    report['concurrency'] = metrics.concurrency()
+    report['job_timings'] = [
+        collections.OrderedDict([
+            ('server', job.server),
+            ('cmd_num', job.cmd_num),
+            ('retval', job.retval),
+            ('attempts', job.attempts),
+            ('stdout_bytes', job.stdout_bytes),
+            ('stderr_bytes', job.stderr_bytes),
+        ] + list(job.timing._asdict().items()))
+        for job in metrics.jobs
+    ]
+    return json.dumps(report, indent=2) + '\n'
+
+def _prometheus_label(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+def _metrics_prometheus(metrics):
+    summary = metrics.summary()
+    output_lines = []
+    def _add_metric(name, metric_type, help_string, samples):
+        output_lines.append('# HELP poh_{} {}'.format(name, help_string))
+        output_lines.append('# TYPE poh_{} {}'.format(name, metric_type))
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_string = ','.join(
+                '{}="{}"'.format(label, _prometheus_label(label_value))
+                for label, label_value in labels
+            )
+            if label_string:
+                label_string = '{' + label_string + '}'
+            output_lines.append('poh_{}{} {!r}'.format(name, label_string,
+                                                       value))
+
+    _add_metric('run_start_time_seconds', 'gauge',
+                "When the run started.", [((), summary['start_time'])])
+    _add_metric('run_duration_seconds', 'gauge',
+                "How long the run took.", [((), summary['duration'])])
+    _add_metric('jobs', 'gauge', "Jobs in the run, by whether they ran.",
+                [((('ran', 'true'),), summary['jobs_run']),
+                 ((('ran', 'false'),),
+                  summary['jobs'] - summary['jobs_run'])])
+    for name, key, help_string in [
+            ('job_latency_seconds', 'latency',
+             "Time from spawning ssh until it exited."),
+            ('job_first_output_seconds', 'first_output',
+             "Time from spawning ssh until its first output.")]:
+        _add_metric(name, 'gauge', help_string, [
+            ((('quantile', '{:g}'.format(percent / 100.0)),),
+             summary[key]['p{}'.format(percent)])
+            for percent in _PERCENTILES
+        ] + [((('quantile', '1'),), summary[key]['max'])])
+    _add_metric('retries', 'gauge', "Retries of jobs that failed to connect.",
+                [((), summary['retries'])])
+    _add_metric('max_concurrency', 'gauge',
+                "Most jobs running at the same time.",
+                [((), summary['max_concurrency'])])
+    _add_metric('mean_concurrency', 'gauge',
+                "Jobs running at the same time, on average.",
+                [((), summary['mean_concurrency'])])
+    _add_metric('captured_bytes', 'gauge', "Output captured, by stream.",
+                [((('stream', 'stdout'),), summary['stdout_bytes']),
+                 ((('stream', 'stderr'),), summary['stderr_bytes'])])
+    _add_metric('slowest_job_latency_seconds', 'gauge',
+                "Latency of the slowest jobs.", [
+                    ((('server', job['server']), ('cmd', job['cmd_num'])),
+                     job['latency'])
+                    for job in summary['slowest']
+                ])
+    return '\n'.join(output_lines) + '\n'
+
+_METRICS_FORMATTERS = collections.OrderedDict([
+    ('json', _metrics_json),
+    ('prometheus', _metrics_prometheus),
+])
+
+def _write_metrics(metrics, metrics_file, metrics_format):
+    # Written aside and moved in place, as collectors may read it any time
+    temp_path = '{}.tmp'.format(metrics_file)
+    with io.open(temp_path, 'w', encoding='utf-8') as output_file:
+        output_file.write(u'{}'.format(
+            _METRICS_FORMATTERS[metrics_format](metrics)
+        ))
+    os.rename(temp_path, metrics_file)
+    LOG.debug("Wrote %s metrics to %r", metrics_format, metrics_file)
+
+_Regression = collections.namedtuple('_Regression', [
+    'server', 'job', 'duration', 'usual_duration', 'runs',
+])
+
+def _history_digest(history_key):
+    import hashlib
+    return hashlib.sha1(history_key.encode('utf-8')).hexdigest()[:16]
+
+def _valid_history_entry(entry):
+    """Whether ``entry`` is an average duration, its runs and the last one."""
+    return isinstance(entry, list) and len(entry) in (2, 3,) and \
+        all(isinstance(number, (int, float,)) and
+            not isinstance(number, bool) for number in entry)
+
+def _valid_durations(durations):
+    return isinstance(durations, dict) and all(
+        isinstance(server_durations, dict) and
+        all(_valid_history_entry(entry)
+            for entry in server_durations.values())
+        for server_durations in durations.values()
+    )
+
+class _RunHistory(object):
+    """How long jobs took on each server in earlier runs.
+
+    It's kept in a JSON file as the weighted average of the durations (from
+    spawning ssh until it exits) of the jobs running the same commands on
+    a server, along with the number of runs it's made of and when the last
+    one was. Lanes are put in the order of how long they're expected to
+    take, longest first, with the ones not run before ahead of them all.
+    Jobs taking much longer than their average of enough runs are recorded
+    as regressions.
+
+    Only the ``_HISTORY_CMDS_PER_SERVER`` commands last run on a server
+    are kept, of the ``_HISTORY_MAX_SERVERS`` servers last run on, and
+    none that weren't run in ``_HISTORY_MAX_AGE`` seconds, so that the file
+    doesn't grow with every command or server ever run. A history that
+    can't be read is started anew, and one that can't be saved is let go,
+    neither of them fails the run.
+    """
+
+    def __init__(self, path):
+        import json
+        self.path = path
+        self.durations = {}
+        self.regressions = []
+        try:
+            with io.open(path, 'r', encoding='utf-8') as history_file:
+                durations = json.load(history_file)['durations']
+        except (IOError, OSError, ValueError, KeyError, TypeError) as exc:
+            LOG.debug("Starting a new history, couldn't read %r: %s", path,
+                      exc)
+        else:
+            if _valid_durations(durations):
+                self.durations = durations
+            else:
+                LOG.warning("Starting a new history, %r isn't one", path)
+        now = time.time()
+        for server_durations in self.durations.values():
+            for entry in server_durations.values():
+                if len(entry) < 3:
+                    # Kept before entries had when they were last run
+                    entry.append(now)
+
+    def _entry(self, server, history_key):
+        if history_key is None:
+            return None
+        return self.durations.get(server, {}).get(
+            _history_digest(history_key)
+        )
+
+    def expected_duration(self, lane):
+        """Seconds the jobs of a lane are expected to take, None if unknown."""
+        expected = 0.0
+        for job in lane:
+            entry = self._entry(job.server, job.history_key)
+            if entry is None:
+                return None
+            expected += entry[0]
+        return expected
+
+    def ordered(self, lanes):
+        """The lanes, those expected to take longest first.
+
+        Lanes not run before go first anyway, so they're handed out as
+        they're made, until one that was run before comes up. Only then are
+        the rest of them all made, to be sorted before the next one is run.
+        """
+        if not self.durations:
+            return lanes
+        return self._ordered(lanes)
+
+    def _ordered(self, lanes):
+        lanes = iter(lanes)
+        for lane in lanes:
+            lane = list(lane)
+            if self.expected_duration(lane) is None:
+                yield lane
+                continue
+            lanes = [lane] + [list(lane) for lane in lanes]
+            def _sortkey(lane):
+                expected = self.expected_duration(lane)
+                return float('inf') if expected is None else expected
+            lanes.sort(key=_sortkey)
+            # Taken from the end, so that lanes are let go of, along with
+            # the jobs they ran, as they're handed out
+            while lanes:
+                yield lanes.pop()
+            return
+
+    def on_finish(self, job):
+        timing = job.timing
+        if job.status is not None or job.history_key is None or \
+           None in (timing.spawned, timing.exited) or job.connection_failed():
+            # Timed out, not run, or not connected to, it says nothing of
+            # how long it usually takes
+            return
+        duration = timing.exited - timing.spawned
+        server_durations = self.durations.setdefault(job.server, {})
+        digest = _history_digest(job.history_key)
+        if digest not in server_durations:
+            server_durations[digest] = [duration, 1, timing.exited]
+            if len(server_durations) > _HISTORY_CMDS_PER_SERVER:
+                del server_durations[min(
+                    server_durations, key=lambda key: server_durations[key][2]
+                )]
+            return
+        usual_duration, runs, _ = server_durations[digest]
+        if runs >= _HISTORY_MIN_RUNS and \
+           duration > usual_duration * _REGRESSION_FACTOR and \
+           duration - usual_duration > _REGRESSION_MIN_SECONDS:
+            self.regressions.append(_Regression(job.server, str(job),
+                                                duration, usual_duration,
+                                                runs))
+        server_durations[digest] = [
+            usual_duration + _HISTORY_WEIGHT * (duration - usual_duration),
+            runs + 1,
+            timing.exited,
+        ]
+
+    def _prune(self):
+        """Let go of entries too old, and of servers past the last ones."""
+        oldest = time.time() - _HISTORY_MAX_AGE
+        last_runs = {}
+        for server, server_durations in self.durations.items():
+            for digest, entry in list(server_durations.items()):
+                if entry[2] < oldest:
+                    del server_durations[digest]
+            if server_durations:
+                last_runs[server] = max(entry[2] for entry in
+                                        server_durations.values())
+        servers = sorted(last_runs, key=last_runs.get, reverse=True)
+        self.durations = dict((server, self.durations[server],)
+                              for server in servers[:_HISTORY_MAX_SERVERS])
+
+    def save(self):
+        try:
+            self._save()
+        except (IOError, OSError) as exc:
+            LOG.warning("Couldn't save the history to %r: %s", self.path, exc)
+
+    def _save(self):
+        import json
+        self._prune()
+        history_dir = os.path.dirname(self.path)
+        if history_dir and not os.path.isdir(history_dir):
+            os.makedirs(history_dir, mode=0o700)
+        # Written aside and moved in place, other runs may be reading it
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with io.open(temp_path, 'w', encoding='utf-8') as history_file:
+            history_file.write(u'{}'.format(json.dumps(
+                {'durations': self.durations}, sort_keys=True,
+                separators=(',', ':',)
+            )))
+        os.rename(temp_path, self.path)
+        LOG.debug("Saved history of %d servers to %r", len(self.durations),
+                  self.path)
+
+    def regression_lines(self, color=False):
+        output_lines = []
+        if not self.regressions:
+            return output_lines
+        output_lines.append('')
+        if color:
+            output_lines.append(_escaped_with("Slower than usual:",
+                                              ['fg_yellow']))
+        else:
+            output_lines.append("Slower than usual:")
+        output_lines.extend([
+            "  {:>10s}  {} (usually {:0.3f}s over {} runs)".format(
+                '{:0.3f}s'.format(regression.duration), regression.job,
+                regression.usual_duration, regression.runs
+            )
+            for regression in sorted(
+                self.regressions,
+                key=lambda regression: regression.usual_duration -
+                regression.duration
+            )
+        ])
+        return output_lines
+
+def _is_control_socket_noise(line):
+    return line.startswith('ControlSocket ') and \
+        'already exists, disabling multiplexing' in line
 
 def redirect_streams(output_dir, quiet, transpose_output=False,
                      color=False):
-    import glob
-    globs = {filetype:'*.?.{}'.format(filetype) for filetype in [
-        'retval', 'stdout', 'stderr'
-    ]}
-    filepaths = {filetype: sorted(glob.glob(os.path.join(output_dir, pat)))
-                 for filetype, pat in globs.items()}
-
-    filepath_tuples = []
-    for fpath in itertools.chain(filepaths['stderr'], filepaths['stdout']):
-        srv, cmd_num, stream = os.path.basename(fpath).rsplit('.', 2)
-        dest_stream = sys.stdout if stream == 'stdout' else sys.stderr
-        filepath_tuples.append((srv, cmd_num, stream, dest_stream, fpath))
+    _redirect_results(_ResultTable(_results_from_dir(output_dir)), quiet,
+                      transpose_output, color)
 
-    retvals = {}
-    for fpath in filepaths['retval']:
-        srv, cmd_num, stream = os.path.basename(fpath).rsplit('.', 2)
-        retvals[(srv, cmd_num)] = _read_int_from_file(fpath)
+def _table_outputs(table, transpose_output=False):
+    """Every output in ``table`` along with its server and command.
 
-    sortkey = operator.itemgetter(0, 1, 2)
-    if transpose_output:
-        sortkey = operator.itemgetter(1, 0, 2)
+    Outputs of each command are given stderr first, as they're written.
+    """
+    for row in table.rows(transpose_output):
+        for stream in ['stderr', 'stdout']:
+            dest_stream = sys.stdout if stream == 'stdout' else sys.stderr
+            yield (table.server(row), table.cmd_nums[row], stream,
+                   dest_stream, table.output(row, stream), table.retval(row))
 
-    filepath_tuples = sorted(filepath_tuples, key=sortkey)
+def _redirect_results(table, quiet, transpose_output=False, color=False):
+    output_tuples = _table_outputs(table, transpose_output)
 
     if quiet:
-        for srv, cmd_num, _, dest_stream, fpath in filepath_tuples:
-            with open(fpath, 'r') as resultfile:
-                shutil.copyfileobj(resultfile, dest_stream)
+        for srv, cmd_num, _, dest_stream, output, _ in output_tuples:
+            for line in output.iter_lines():
+                dest_stream.write(line)
         return
 
     line_format = '{}:\t{}'
     no_stderr = set()
 
-    for srv, cmd_num, _, dest_stream, fpath in filepath_tuples:
-        if not color:
-            srv = srv
-        elif retvals[(srv, cmd_num)] == 0:
-            srv = _escaped_with(srv, ['fg_green'])
-        else:
-            srv = _escaped_with(srv, ['fg_red'])
-        if dest_stream is sys.stderr and os.stat(fpath).st_size == 0:
+    for srv, cmd_num, _, dest_stream, output, retval in output_tuples:
+        if color:
+            srv = _escaped_with(srv, [_retval_color(retval)])
+        if dest_stream is sys.stderr and retval in _STATUSES:
+            status_string = '<{}>'.format(retval)
+            dest_stream.write(line_format.format(srv, _escaped_with(
+                status_string, ['fg_yellow']
+            ) if color else status_string))
+            dest_stream.write('\n')
+        # Output is read line by line as it's written, an output without a
+        # first line is empty
+        lines = output.iter_lines()
+        first_line = next(lines, None)
+        if first_line is not None:
+            lines = itertools.chain([first_line], lines)
+        if dest_stream is sys.stderr and first_line is None:
             no_stderr.add((srv, cmd_num,))
-        elif dest_stream is sys.stdout and os.stat(fpath).st_size == 0:
+        elif dest_stream is sys.stdout and first_line is None:
             if (srv, cmd_num,) in no_stderr:
                 dest_stream.write(line_format.format(srv, _escaped_with(
                     '<EMPTY OUTPUT>', ['fg_yellow']
@@ -855,8 +3915,7 @@ def redirect_streams(output_dir, quiet, transpose_output=False,
         elif dest_stream is sys.stderr:
             def writefunc(line):
                 out_line = line
-                if line.startswith('ControlSocket ') and \
-                   'already exists, disabling multiplexing' in line:
+                if _is_control_socket_noise(line):
                     LOG.debug("Got ControlSocket message from ssh,"
                               " removing from stderr. Line: %r", line)
                     return
@@ -868,37 +3927,416 @@ def redirect_streams(output_dir, quiet, transpose_output=False,
             writefunc = lambda line: dest_stream.write(
                 line_format.format(srv, line)
             )
-        with open(fpath, 'r') as resultfile:
-            for line in resultfile.readlines():
-                writefunc(line)
+        for line in lines:
+            writefunc(line)
+
+class _LiveReport(object):
+    """Print the results of every command as soon as its job is done.
+
+    Results are printed in the order they complete, one block per command
+    like the ones print_execution_results prints per server, with the time
+    header at the end as the run's end time isn't known until then.
+    """
+
+    def __init__(self, commands, one_line=False, long_output=False,
+                 wide_output=False, color=False):
+        self.one_line = one_line
+        self.color = color
+        self.cmds_by_num = collections.OrderedDict(
+            enumerate(itertools.chain(*commands.values()), 1)
+        )
+
+        term_columns, term_lines = _get_terminal_size(sys.stdout.fileno())
+        self.long_output = long_output or term_lines is None
+        self.limit_lines = term_lines
+        self.term_columns = term_columns
+        self.shortened = None
+        if not wide_output and term_columns is not None:
+            self.shortened = _line_shortener(term_columns, color)
+
+    def _print_lines(self, output_lines):
+        if self.shortened is not None:
+            output_lines = (self.shortened(line)
+                            if len(line) > self.term_columns else line
+                            for line in output_lines)
+        _write_lines(output_lines)
+
+    def _cmd_lines(self, server, cmd_num, cmdres):
+        retval = cmdres['retval'][0]
+        if self.one_line:
+            return ["  {}:  cmd#{:<4d} {}  {}".format(
+                server, cmd_num, _formatted_retval(retval, self.color),
+                cmdres['stdout'][0].split('\n', 1)[0]
+            )]
+
+        output_lines = ["  {} cmd#{:<4d} {:12s} (l#:{}/{}){} $ {}".format(
+            server,
+            cmd_num,
+            _formatted_retval(retval, self.color),
+            cmdres['stderr'][1],
+            cmdres['stdout'][1],
+            _attempts_note(cmdres),
+            _printable_string(self.cmds_by_num[cmd_num])
+        )]
+        output_lines.extend(_std_streams_lines(cmdres,
+                                               long_output=self.long_output,
+                                               limit_lines=self.limit_lines))
+        return output_lines
+
+    def start(self):
+        self._print_lines(_commands_lines(list(self.cmds_by_num.items()),
+                                          self.color))
+
+    def on_output(self, job, stream_name, text):
+        pass
+
+    def on_finish(self, job):
+        tail_lines = None if self.long_output else self.limit_lines
+        for result in job.results:
+            cmdres = _cmd_outputs(result, self.one_line, tail_lines)
+            self._print_lines(self._cmd_lines(result.server, result.cmd_num,
+                                              cmdres))
+
+    def close(self, times):
+        self._print_lines([''] + _time_header_lines(times, self.color)[:-1])
+
+class _LiveRedirector(object):
+    """Forward output of jobs line by line as it arrives, as -r/-q do.
+
+    Jobs that don't stream the output of their commands as is (batches)
+    have it forwarded from their results once they are done.
+    """
+
+    def __init__(self, quiet, color=False):
+        self.quiet = quiet
+        self.color = color
+        self.partial_lines = {}
+        self.with_output = set()
+
+    def _write_lines(self, server, cmd_num, stream_name, lines):
+        dest_stream = sys.stdout if stream_name == 'stdout' else sys.stderr
+        for line in lines:
+            if self.quiet:
+                dest_stream.write(line)
+                continue
+            if stream_name == 'stderr':
+                if _is_control_socket_noise(line):
+                    LOG.debug("Got ControlSocket message from ssh,"
+                              " removing from stderr. Line: %r", line)
+                    continue
+                if self.color:
+                    line = _escaped_with(line, ['fg_red'])
+            self.with_output.add((server, cmd_num,))
+            dest_stream.write('{}:\t{}'.format(server, line))
+        dest_stream.flush()
+
+    def _write_marker(self, server, dest_stream, marker):
+        if self.color:
+            marker = _escaped_with(marker, ['fg_yellow'])
+        dest_stream.write('{}:\t{}\n'.format(server, marker))
+        dest_stream.flush()
+
+    def start(self):
+        pass
+
+    def on_output(self, job, stream_name, text):
+        if not job.streams_output:
+            return
+        key = (job.server, job.cmd_num, stream_name,)
+        lines = (self.partial_lines.pop(key, '') + text).splitlines(True)
+        if lines and not lines[-1].endswith('\n'):
+            self.partial_lines[key] = lines.pop()
+        self._write_lines(job.server, job.cmd_num, stream_name, lines)
+
+    def on_finish(self, job):
+        for result in job.results:
+            server, cmd_num = result.server, result.cmd_num
+            for stream_name in ['stderr', 'stdout']:
+                if job.streams_output:
+                    # Lines of other jobs may follow, so an unterminated last
+                    # line gets terminated unless the output is quiet
+                    key = (server, cmd_num, stream_name,)
+                    lines = []
+                    if key in self.partial_lines:
+                        lines.append(self.partial_lines.pop(key))
+                        if not self.quiet:
+                            lines[-1] += '\n'
+                else:
+                    lines = getattr(result, stream_name).iter_lines()
+                self._write_lines(server, cmd_num, stream_name, lines)
+
+            if self.quiet:
+                continue
+            retval = result.retval
+            if retval in _STATUSES:
+                self._write_marker(server, sys.stderr, '<{}>'.format(retval))
+            elif (server, cmd_num,) not in self.with_output:
+                self._write_marker(server, sys.stdout, '<EMPTY OUTPUT>')
+            self.with_output.discard((server, cmd_num,))
+
+    def close(self, times):
+        pass
+
+class _JsonLinesWriter(object):
+    """Write a line of JSON for every command as soon as its job is done.
+
+    Every record has the server, command number and command, the return
+    value, the whole stdout and stderr with their line counts, and the
+    timing of the job, as seconds since the epoch.
+    """
+
+    def __init__(self, commands):
+        self.cmds_by_num = collections.OrderedDict(
+            enumerate(itertools.chain(*commands.values()), 1)
+        )
+
+    def start(self):
+        pass
+
+    def on_output(self, job, stream_name, text):
+        pass
+
+    def on_finish(self, job):
+        import json
+        for result in job.results:
+            stdout, stdout_ln = _cmd_output(result, 'stdout')
+            stderr, stderr_ln = _cmd_output(result, 'stderr')
+            record = collections.OrderedDict([
+                ('server', result.server),
+                ('cmd_num', result.cmd_num),
+                ('cmd', self.cmds_by_num.get(result.cmd_num)),
+                ('retval', result.retval),
+                ('attempts', result.attempts),
+                ('stdout', stdout),
+                ('stderr', stderr),
+                ('stdout_lines', stdout_ln),
+                ('stderr_lines', stderr_ln),
+                ('timing', job.timing._asdict()),
+            ])
+            sys.stdout.write(json.dumps(record))
+            sys.stdout.write('\n')
+        sys.stdout.flush()
+
+    def close(self, times):
+        pass
+
+class CommandResult(collections.namedtuple('CommandResult', [
+        'server', 'cmd_num', 'cmd', 'retval', 'attempts', 'stdout', 'stderr',
+        'stdout_size', 'stderr_size', 'timing',
+])):
+    """The result of a command on a server, as iter_results yields it.
+
+    ``stdout`` and ``stderr`` are handles to the outputs, read from only when
+    asked to through their ``read()``, ``text()``, ``tail(num_lines)``,
+    ``first_line()`` and ``iter_lines()``, with ``line_count`` lines in them.
+    ``timing`` has when ssh was spawned, first wrote output, exited and was
+    reaped, as seconds since the epoch, all None for commands that never ran.
+    """
+
+    __slots__ = ()
+
+def iter_results(servers, commands, ssh_config=None, output_dir=None,
+                 max_parallel=_DEFAULT_MAX_PARALLEL,
+                 exec_mode=_DEFAULT_EXEC_MODE, control_master=False,
+                 control_persist=0, timeout=None, run_timeout=None,
+                 pack_output=False, compress_output=False, retries=0,
+                 retry_budget=None, retry_backoff=_DEFAULT_RETRY_BACKOFF,
+                 relays=None, rolling=None, max_failures=0):
+    """Run commands on servers, yielding a CommandResult as each is done.
+
+    ``commands`` is a list of commands, or commands by the file they were
+    read from as run_poh takes them. Nothing is printed, and results are
+    only held on to by whoever iterates over them. Stopping the iteration
+    early kills the commands still running.
+
+    Outputs are kept in ``output_dir`` if given, which has to exist, as
+    run_poh keeps them. Otherwise they are kept in memory, or in a temporary
+    directory once they grow large, which is removed once neither the
+    iteration nor any of the results whose outputs are in it are left.
+    """
+    if not hasattr(commands, 'values'):
+        commands = collections.OrderedDict([(None, list(commands))])
+    cmds_by_num = dict(enumerate(itertools.chain(*commands.values()), 1))
+
+    keep_output = output_dir is not None
+    temporary_dir = None
+    if not keep_output:
+        temporary_dir = _TemporaryOutputDir()
+        output_dir = temporary_dir.path
+    if ssh_config is None and 'SSH_CONFIG' in os.environ:
+        ssh_config = os.environ['SSH_CONFIG']
+
+    for job in _finished_jobs(servers, commands, output_dir, ssh_config,
+                              max_parallel, exec_mode, control_master,
+                              control_persist, timeout, run_timeout,
+                              keep_output=keep_output,
+                              pack_output=pack_output and keep_output,
+                              compress_output=compress_output,
+                              retries=retries, retry_budget=retry_budget,
+                              retry_backoff=retry_backoff, relays=relays,
+                              rolling=rolling, max_failures=max_failures):
+        timing = job.timing
+        for result in job.results:
+            if temporary_dir is not None:
+                for output in (result.stdout, result.stderr):
+                    if getattr(output, 'on_disk', False):
+                        output.output_dir = temporary_dir
+            yield CommandResult(
+                result.server, result.cmd_num,
+                cmds_by_num.get(result.cmd_num), result.retval,
+                result.attempts, result.stdout, result.stderr,
+                result.stdout.size, result.stderr.size, timing,
+            )
 
 def run_poh(servers, commands, ssh_config=None, output_dir=None,
             keep_output=False, quiet_output=False, raw_output=False,
             one_line=False, long_output=False, wide_output=False,
-            transpose_output=False, color=False):
+            transpose_output=False, color=False,
+            max_parallel=_DEFAULT_MAX_PARALLEL,
+            exec_mode=_DEFAULT_EXEC_MODE, control_master=False,
+            control_persist=0, timeout=None, run_timeout=None,
+            sync=False, pack_output=False, compress_output=False,
+            summary=False, metrics_file=None,
+            metrics_format=_DEFAULT_METRICS_FORMAT, json_output=False,
+            retries=0, retry_budget=None,
+            retry_backoff=_DEFAULT_RETRY_BACKOFF, relays=None,
+            group_output=False, rolling=None, max_failures=0, resume=False,
+            history_file=None):
 
     if output_dir is not None:
         keep_output = True
     else:
         LOG.debug("Creating temporary directory.")
+        import tempfile
         output_dir = tempfile.mkdtemp()
         LOG.debug("Created temporary directory at %r.", output_dir)
 
+    live_output = None
+    if json_output:
+        live_output = _JsonLinesWriter(commands)
+    elif sync and (raw_output or quiet_output):
+        live_output = _LiveRedirector(quiet_output, color)
+    elif sync:
+        live_output = _LiveReport(commands, one_line, long_output,
+                                  wide_output, color)
+
     start_time = time.time()
+    metrics = None
+    if summary or metrics_file is not None:
+        metrics = _RunMetrics(start_time)
+
+    history = None
+    if history_file is not None:
+        history = _RunHistory(history_file)
+
+    groups = None
+    if group_output and live_output is None and \
+       not (raw_output or quiet_output or one_line):
+        groups = _ResultGroups(keep_output)
+    elif group_output:
+        LOG.debug("Output isn't a report of results, ignoring group_output.")
+
+    on_output = None
+    finish_callbacks = []
+    if live_output is not None:
+        on_output = live_output.on_output
+        finish_callbacks.append(live_output.on_finish)
+    if metrics is not None:
+        finish_callbacks.append(metrics.on_finish)
+    if history is not None:
+        finish_callbacks.append(history.on_finish)
+    if groups is not None:
+        # Last, as it discards outputs of results it groups with others
+        finish_callbacks.append(groups.on_finish)
+
+    def _on_finish(job):
+        for finish_callback in finish_callbacks:
+            finish_callback(job)
+
+    kept_results = []
+    pending = None
+    if resume:
+        if not _resumable_with(output_dir, commands):
+            raise ValueError("Results in {!r} are of other commands, they"
+                             " can't be resumed".format(output_dir))
+        # Only what has to run again is run, results of the rest are kept
+        previous_results = _kept_results(output_dir)
+        servers = list(servers)
+        if not servers:
+            servers = sorted({server for server, _ in previous_results})
+        num_cmds = len(list(itertools.chain(*commands.values())))
+        pending = _pending_jobs(previous_results, servers, num_cmds)
+        requested_servers = set(servers)
+        kept_results = [
+            result for (server, cmd_num), result in previous_results.items()
+            if server in requested_servers and cmd_num <= num_cmds and
+            cmd_num not in pending.get(server, ())
+        ]
+        LOG.debug("Running again %d commands on %d of %d servers",
+                  sum(len(cmd_nums) for cmd_nums in pending.values()),
+                  len(pending), len(servers))
+        servers = list(pending)
+        if groups is not None:
+            for result in kept_results:
+                groups.add(result)
+
+    table = None
+    if live_output is None and groups is None:
+        # Results are only held on to when they're reported once all are in
+        table = _ResultTable(kept_results)
+
     if ssh_config is None and 'SSH_CONFIG' in os.environ:
         ssh_config = os.environ['SSH_CONFIG']
-    remote_execute(servers, commands, output_dir, ssh_config)
+    if live_output is not None:
+        live_output.start()
+    for job in _finished_jobs(servers, commands, output_dir, ssh_config,
+                              max_parallel, exec_mode, control_master,
+                              control_persist, timeout, run_timeout,
+                              on_output=on_output, on_finish=_on_finish,
+                              keep_output=keep_output,
+                              pack_output=pack_output,
+                              compress_output=compress_output,
+                              retries=retries, retry_budget=retry_budget,
+                              retry_backoff=retry_backoff, relays=relays,
+                              rolling=rolling, max_failures=max_failures,
+                              pending=pending, history=history):
+        if table is not None:
+            for result in job.results:
+                table.add(result)
     end_time = time.time()
-    if raw_output or quiet_output:
-        redirect_streams(output_dir, quiet_output, transpose_output, color)
+    if metrics is not None:
+        metrics.close(end_time)
+    if live_output is not None:
+        live_output.close((start_time, end_time,))
+    elif raw_output or quiet_output:
+        _redirect_results(table, quiet_output, transpose_output, color)
+    elif groups is not None:
+        print_execution_results(groups, commands, one_line, long_output,
+                                wide_output, transpose_output, color,
+                                times=(start_time, end_time,), grouped=True)
     else:
-        outputs = read_result_files(output_dir, one_line)
+        tail_lines = None
+        if not long_output:
+            _, tail_lines = _get_terminal_size(sys.stdout.fileno())
+        outputs = table.by_server(one_line, tail_lines)
         print_execution_results(outputs, commands, one_line, long_output,
                                 wide_output, transpose_output, color,
                                 times=(start_time, end_time,))
 
+    # Outputs of commands go to stdout as they are with -r, -q and --json
+    info_stream = sys.stdout
+    if raw_output or quiet_output or json_output:
+        info_stream = sys.stderr
+    if summary:
+        _write_lines(metrics.summary_lines(color), info_stream)
+    if history is not None:
+        _write_lines(history.regression_lines(color), info_stream)
+        history.save()
+    if metrics_file is not None:
+        _write_metrics(metrics, metrics_file, metrics_format)
+
     if keep_output:
-        print("\nOutput located at: {}".format(output_dir))
+        print("\nOutput located at: {}".format(output_dir), file=info_stream)
     else:
         _remove_output_dir(output_dir)
 
@@ -916,17 +4354,33 @@ def main_exe():
         # TODO: change this to be a path, rather than a file
         args.ssh_config = args.ssh_config.name
 
-    args.keep_output = args.keep_output or (args.output_dir is not None)
+    if args.resume is not None:
+        if args.output_dir not in (None, args.resume):
+            _show_error_messages(["--resume and -o name different"
+                                  " directories"])
+            parser.print_usage()
+            sys.exit(64)
+        args.output_dir = args.resume
 
-    args.servers = {server for server in _get_servers(args.servers)}
-    if not sys.stdin.isatty() or '-' in args.servers:
-        args.servers.discard('-')
-        args.servers |= {line.rstrip('\n') for line in sys.stdin.readlines()
-                         if not line.startswith('#') and line != ''}
-    args.servers = sorted(args.servers)
+    args.keep_output = args.keep_output or (args.output_dir is not None)
+    args.pack_output = args.pack_output or args.compress_output
+    args.control_master = args.control_master or args.control_persist > 0
+
+    args.relays = list(_get_servers(args.relays))
+
+    stdin = None
+    if not sys.stdin.isatty() or '-' in _server_patterns(args.servers):
+        stdin = sys.stdin
+    inventory = _server_inventory(args.servers, args.hosts_files, stdin)
+    # Only the first server is waited for, the rest are read as they're run
+    first_server = next(inventory, None)
+    if first_server is None:
+        inventory = []
+    else:
+        inventory = itertools.chain([first_server], inventory)
 
     err_msgs = []
-    if not args.servers:
+    if first_server is None and args.resume is None:
         err_msgs.append("You must specify at least one server")
 
     args.pos_cmds = [cmd for cmd in args.pos_cmds if cmd != ""]
@@ -968,6 +4422,13 @@ def main_exe():
         args.commands.pop(None)
         args.commands[None] = args.pos_cmds
 
+    if args.resume is not None and \
+       not _resumable_with(args.resume, args.commands):
+        _show_error_messages(["The results in {} are of other commands,"
+                              " they can't be resumed with these".format(
+                                  args.resume)])
+        sys.exit(64)
+
     # TODO: save a representation of them here at preproc, rather than at
     # different points in execution _printable_string for all commands
 
@@ -981,17 +4442,32 @@ def main_exe():
         _show_on_stderr(
             "Would've executed {} commands on {} servers".format(
                 sum([len(cmdlist) for cmdlist in args.commands.values()]),
-                len(args.servers)
+                sum(1 for _ in inventory)
             )
         )
         sys.exit(0)
 
     try:
-        run_poh(args.servers, args.commands, args.ssh_config,
+        run_poh(inventory, args.commands, args.ssh_config,
                 args.output_dir, args.keep_output,
                 args.quiet_output, args.raw_output,
                 args.one_line, args.long_output, args.wide_output,
-                args.transpose_output, args.color)
+                args.transpose_output, args.color,
+                max_parallel=args.max_parallel, exec_mode=args.exec_mode,
+                control_master=args.control_master,
+                control_persist=args.control_persist,
+                timeout=args.timeout, run_timeout=args.run_timeout,
+                sync=args.sync, pack_output=args.pack_output,
+                compress_output=args.compress_output, summary=args.summary,
+                metrics_file=args.metrics_file,
+                metrics_format=args.metrics_format,
+                json_output=args.json_output, retries=args.retries,
+                retry_budget=args.retry_budget,
+                retry_backoff=args.retry_backoff, relays=args.relays,
+                group_output=args.group_output, rolling=args.rolling,
+                max_failures=args.max_failures,
+                resume=args.resume is not None,
+                history_file=args.history_file)
     except IOError as exc:
         if errno.EPIPE == exc.errno:
             sys.stdout.close()
@@ -0,0 +1,69 @@
+"""Reading the results kept in an output directory as dicts."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import poh
+
+
+class ReadResultFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        for server, cmd_num, retval, stdout, stderr in [
+                ('web1', 1, 0, u'up 3 days\n', u''),
+                ('web1', 2, 1, u'', u'no such file\n'),
+                ('web2', 1, 0, u'up 5 days\nload 0.1\n', u''),
+        ]:
+            for filetype, contents in [('retval', u'{}\n'.format(retval)),
+                                       ('stdout', stdout),
+                                       ('stderr', stderr)]:
+                path = os.path.join(self.output_dir, '{}.{}.{}'.format(
+                    server, cmd_num, filetype
+                ))
+                with io.open(path, 'w', encoding='utf-8') as result_file:
+                    result_file.write(contents)
+
+    def test_results_are_nested_dicts(self):
+        results = poh.read_result_files(self.output_dir)
+        self.assertEqual(sorted(results), ['web1', 'web2'])
+        self.assertEqual(sorted(results['web1'].keys()), [1, 2])
+
+        outputs = results['web1'][2]
+        self.assertEqual(sorted(outputs),
+                         ['attempts', 'retval', 'stderr', 'stdout'])
+        self.assertEqual(len(outputs), 4)
+        self.assertEqual(outputs['retval'], (1, 1))
+        self.assertEqual(outputs.get('stderr'), (u'no such file\n', 1))
+        self.assertIsNone(outputs.get('missing'))
+        self.assertEqual(dict(outputs.items())['stdout'], (u'', 0))
+
+    def test_outputs_convert_to_plain_dicts(self):
+        results = poh.read_result_files(self.output_dir)
+        as_dicts = dict(
+            (server, dict((cmd_num, dict(outputs))
+                          for cmd_num, outputs in cmd_results.items()))
+            for server, cmd_results in results.items()
+        )
+        self.assertEqual(as_dicts['web2'][1], {
+            'retval': (0, 1),
+            'stdout': (u'up 5 days\nload 0.1\n', 2),
+            'stderr': (u'', 0),
+            'attempts': (1, 1),
+        })
+
+    def test_one_line(self):
+        results = poh.read_result_files(self.output_dir, one_line=True)
+        self.assertEqual(results['web2'][1]['stdout'], (u'up 5 days\n', None))
+
+
+if __name__ == '__main__':
+    unittest.main()